@@ -1,5 +1,6 @@
 from constants import *
 from config import Config
+from cache import cache_db
 import tornado.ioloop
 import tornado.web
 import logging
@@ -12,16 +13,19 @@ import uuid
 logger = logging.getLogger(APP_NAME)
 
 class AppServer(Config):
-    bool_options = {'ssl', 'log_debug'}
-    int_options = {'port'}
+    bool_options = {'ssl', 'log_debug', 'output_events'}
+    int_options = {'port', 'cache_max_memory', 'output_raw_sample'}
     path_options = {'log_path', 'data_path', 'server_cert_path',
         'server_key_path'}
-    str_options = {'bind_addr', 'api_key'}
+    str_options = {'bind_addr', 'api_key', 'cache_eviction'}
     default_options = {
         'get_public_ip': True,
         'inline_certs': True,
         'ssl': True,
         'data_path': DEFAULT_DATA_PATH,
+        'cache_eviction': CACHE_EVICT_LRU,
+        'output_events': True,
+        'output_raw_sample': 1,
     }
     chmod_mode = 0600
 
@@ -48,6 +52,11 @@ class AppServer(Config):
             self.api_key = uuid.uuid4().hex
             self.commit()
 
+    def _setup_cache(self):
+        if self.cache_max_memory:
+            cache_db.set_max_memory(self.cache_max_memory,
+                self.cache_eviction)
+
     def _setup_log(self):
         if self.log_debug:
             self.log_level = logging.DEBUG
@@ -101,6 +110,7 @@ class AppServer(Config):
         self._setup_app()
         self._setup_conf()
         self._setup_log()
+        self._setup_cache()
         self._setup_handlers()
 
     def _run_server(self):
@@ -1,15 +1,27 @@
 from constants import *
-import Queue
+from exceptions import *
+from cache_snapshot import SnapshotWriter, SnapshotReader, RECORD_KEY, \
+    RECORD_REMOVE, is_snapshot
+import tornado.ioloop
+import tornado.concurrent
+import logging
 import time
 import collections
+import contextlib
 import threading
 import thread
 import uuid
 import copy
 import itertools
+import heapq
+import bisect
+import random
+import sys
 import json
 import os
 
+logger = logging.getLogger(APP_NAME)
+
 TRANSACTION_METHODS = {
     'set',
     'increment',
@@ -17,6 +29,7 @@ TRANSACTION_METHODS = {
     'remove',
     'rename',
     'expire',
+    'expire_at',
     'set_add',
     'set_remove',
     'list_lpush',
@@ -25,424 +38,1880 @@ TRANSACTION_METHODS = {
     'list_rpop',
     'list_remove',
     'dict_set',
+    'dict_set_many',
     'dict_remove',
+    'mset',
 }
 
-class Cache:
+def _elem_size(value):
+    if value is None:
+        return CACHE_ELEMENT_OVERHEAD
+    return len(value) + CACHE_ELEMENT_OVERHEAD
+
+def _elems_size(values):
+    # Same as the sum of _elem_size without a call for every element
+    size = len(values) * CACHE_ELEMENT_OVERHEAD
+    try:
+        return size + sum(map(len, values))
+    except TypeError:
+        # None elements only count the overhead
+        return size + sum(len(x) for x in values if x is not None)
+
+def _entry_size(key, val):
+    size = len(key) + CACHE_KEY_OVERHEAD
+    if isinstance(val, basestring):
+        size += len(val)
+    elif isinstance(val, dict):
+        size += _elems_size(val) + _elems_size(val.values())
+    elif val is not None:
+        size += _elems_size(val)
+    return size
+
+def _call_arg(call, index, name):
+    # Recorded calls keep the arguments as they were passed
+    if len(call[1]) > index:
+        return call[1][index]
+    return call[2][name]
+
+class CacheEntry(object):
+    __slots__ = ('ttl', 'val', 'size', 'atime', 'freq', 'shared')
+
     def __init__(self):
+        self.ttl = None
+        self.val = None
+        self.size = 0
+        self.atime = 0
+        self.freq = 0
+        self.shared = False
+
+class CacheShard:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.used = 0
+        self.data = {}
+        self.keys = CacheKeys()
+        self.dirty = set()
+
+class CacheSubscriber:
+    def __init__(self, cache, channel, timeout, queue_max, overflow):
+        self.cache = cache
+        self.channel = channel
+        self.timeout = timeout
+        self.event = threading.Event()
+        self.queue = collections.deque()
+        self.queue_max = queue_max
+        self.overflow = overflow
+        self.dropped = 0
+
+    def notify(self):
+        self.event.set()
+
+    def idle(self):
+        self.event.clear()
+
+    def get(self, timeout=None):
+        # Block until a message is available, None is returned on timeout
+        while True:
+            message = self.channel.get(self)
+            if message is not None:
+                return message[1]
+            if not self.event.wait(timeout):
+                return
+
+    def __iter__(self):
+        try:
+            while True:
+                message = self.get(self.timeout)
+                if message is None:
+                    break
+                yield message
+        finally:
+            self.cancel()
+
+    def cancel(self):
+        self.cache._unsubscribe(self.channel, self)
+
+class CacheAsyncSubscriber(CacheSubscriber):
+    def __init__(self, cache, channel, timeout, queue_max, overflow,
+            callback):
+        CacheSubscriber.__init__(self, cache, channel, None, queue_max,
+            overflow)
+        self.callback = callback
+        self.io_loop = tornado.ioloop.IOLoop.current()
+        self.pending = False
+        self.timeout = None
+        if timeout is not None:
+            self.timeout = self.io_loop.add_timeout(time.time() + timeout,
+                self.on_timeout)
+
+    def notify(self):
+        # Called with the channel lock held from any thread, wakeups are
+        # coalesced into one ioloop callback that drains the queue
+        if not self.pending:
+            self.pending = True
+            self.io_loop.add_callback(self.deliver)
+
+    def idle(self):
+        self.pending = False
+
+    def deliver(self):
+        while self.callback:
+            message = self.channel.get(self)
+            if message is None:
+                break
+            self.callback(message[1])
+
+    def on_timeout(self):
+        self.timeout = None
+        callback = self.callback
+        self.cancel()
+        if callback:
+            callback(None)
+
+    def cancel(self):
+        if self.timeout:
+            self.io_loop.remove_timeout(self.timeout)
+            self.timeout = None
+        if self.callback:
+            self.callback = None
+            CacheSubscriber.cancel(self)
+
+class CacheChannel:
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.subs = set()
+        self.dropped = 0
+
+    def subscribe(self, subscriber):
+        with self.lock:
+            self.subs.add(subscriber)
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subs.discard(subscriber)
+
+    def publish(self, message):
+        with self.lock:
+            self.seq += 1
+            for subscriber in self.subs:
+                if len(subscriber.queue) >= subscriber.queue_max:
+                    subscriber.dropped += 1
+                    self.dropped += 1
+                    logger.warning('Cache subscriber queue full, ' + \
+                            'dropping message. %r' % {
+                        'channel': self.name,
+                        'seq': self.seq,
+                        'overflow': subscriber.overflow,
+                        'dropped': subscriber.dropped,
+                    })
+                    if subscriber.overflow == SUB_OVERFLOW_DROP_NEWEST:
+                        continue
+                    subscriber.queue.popleft()
+                subscriber.queue.append((self.seq, message))
+                subscriber.notify()
+
+    def get(self, subscriber):
+        with self.lock:
+            try:
+                return subscriber.queue.popleft()
+            except IndexError:
+                subscriber.idle()
+
+class CacheLock:
+    def __init__(self, key, lock):
+        self.key = key
+        self.cond = threading.Condition(lock)
+        self.refs = 0
+        self.owner = None
+        self.owner_name = None
+        self.owner_time = None
+        self.readers = {}
+        self.writers_waiting = 0
+
+    def available(self, ident, shared):
+        if self.owner is not None:
+            return False
+        if shared:
+            # Waiting writers block new readers so they are not starved,
+            # a thread already reading may read again
+            return ident in self.readers or not self.writers_waiting
+        return not self.readers
+
+    def grant(self, ident, shared):
+        if shared:
+            self.readers[ident] = self.readers.get(ident, 0) + 1
+        else:
+            self.owner = ident
+            self.owner_name = threading.current_thread().name
+            self.owner_time = time.time()
+
+    def release(self, ident):
+        if self.owner == ident:
+            self.owner = None
+            self.owner_name = None
+            self.owner_time = None
+            return True
+        count = self.readers.get(ident)
+        if not count:
+            return False
+        if count == 1:
+            del self.readers[ident]
+        else:
+            self.readers[ident] = count - 1
+        return True
+
+    def holders(self):
+        if self.owner is not None:
+            return [self.owner]
+        return self.readers.keys()
+
+class CacheKeys:
+    # Sorted keys split into bounded chunks so an insert or removal only
+    # moves the keys of one chunk
+    def __init__(self):
+        self.chunks = []
+        self.maxes = []
+
+    def add(self, key):
+        if not self.maxes:
+            self.chunks.append([key])
+            self.maxes.append(key)
+            return
+        index = bisect.bisect_left(self.maxes, key)
+        if index == len(self.maxes):
+            index -= 1
+            self.chunks[index].append(key)
+            self.maxes[index] = key
+        else:
+            bisect.insort(self.chunks[index], key)
+
+        chunk = self.chunks[index]
+        if len(chunk) > CACHE_KEYS_CHUNK * 2:
+            half = len(chunk) // 2
+            self.chunks[index:index + 1] = [chunk[:half], chunk[half:]]
+            self.maxes[index:index + 1] = [chunk[half - 1], chunk[-1]]
+
+    def load(self, keys):
+        # Replaces the keys with the keys sorted once
+        keys = sorted(keys)
+        self.chunks = [keys[i:i + CACHE_KEYS_CHUNK]
+            for i in xrange(0, len(keys), CACHE_KEYS_CHUNK)]
+        self.maxes = [chunk[-1] for chunk in self.chunks]
+
+    def remove(self, key):
+        index = bisect.bisect_left(self.maxes, key)
+        if index == len(self.maxes):
+            return
+        chunk = self.chunks[index]
+        pos = bisect.bisect_left(chunk, key)
+        if pos < len(chunk) and chunk[pos] == key:
+            del chunk[pos]
+            if not chunk:
+                del self.chunks[index]
+                del self.maxes[index]
+            elif pos == len(chunk):
+                self.maxes[index] = chunk[-1]
+
+    def iter_from(self, key, inclusive=True):
+        if inclusive:
+            bisect_func = bisect.bisect_left
+        else:
+            bisect_func = bisect.bisect_right
+        index = bisect_func(self.maxes, key)
+        if index == len(self.maxes):
+            return
+        for key in itertools.islice(self.chunks[index],
+                bisect_func(self.chunks[index], key), None):
+            yield key
+        for chunk in itertools.islice(self.chunks, index + 1, None):
+            for key in chunk:
+                yield key
+
+    def __len__(self):
+        return sum(len(chunk) for chunk in self.chunks)
+
+class Cache:
+    def __init__(self, shards=CACHE_SHARDS):
         self._path = None
-        self._set_queue = Queue.Queue()
-        self._data = collections.defaultdict(
-            lambda: {'ttl': None, 'val': None})
+        self._fsync = JOURNAL_FSYNC_EVERYSEC
+        self._journal_file = None
+        self._journal_gen = 0
+        self._journal_size = 0
+        self._journal_dirty = False
+        self._journal_lock = threading.Lock()
+        self._snapshot_lock = threading.RLock()
+        self._snapshot_size = 0
+        self._snapshot_fork = False
+        self._snapshot_compress = True
+        self._snapshot_stats = {}
+        self._delta_size = 0
+        self._delta_stats = {}
+        self._deltas_written = 0
+        self._bytes_written = 0
+        self._bytes_rate = 0
+        self._local = threading.local()
+        self._shards = [CacheShard() for _ in xrange(shards)]
+        self._max_memory = None
+        self._eviction = CACHE_EVICT_LRU
+        self._evicted = 0
+        self._refused = 0
         self._timers = {}
-        self._channels = collections.defaultdict(
-            lambda: {'subs': set(), 'msgs': collections.deque(maxlen=10)})
+        self._expire_heap = []
+        self._expire_cond = threading.Condition()
+        self._expire_enabled = True
+        self._expire_thread_started = False
+        self._channels = {}
+        self._channels_lock = threading.Lock()
+        self._channels_reclaimed = 0
+        self._watches = {}
         self._commit_log = []
-        self._locks = collections.defaultdict(lambda: threading.Lock())
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self._locks_reclaimed = 0
+        self._lock_waits = {}
+        self._lock_contention = collections.OrderedDict()
+        self._lock_contention_other = self._new_wait_stats()
+        self._lock_acquired = 0
+        self._lock_timeouts = 0
+        self._lock_deadlocks = 0
+        self._indexes = {}
+        self._indexes_lock = threading.Lock()
 
-    def _put_queue(self):
-        if self._path:
-            self._set_queue.put('set')
+    def _journal(self, method, *args):
+        if self._watches:
+            self._notify(method, args)
+        if not self._journal_file or getattr(self._local, 'in_trans', False):
+            return
+        line = json.dumps((method, args)) + '\n'
 
-    def _export_thread(self):
-        from pritunl import app_server
-        while not app_server.interrupt:
-            try:
-                self._set_queue.get(timeout=5)
-            except Queue.Empty:
-                continue
-            # Attempt to get more db sets form queue to reduce export calls
-            for i in xrange(30):
+        with self._journal_lock:
+            self._journal_file.write(line)
+            self._journal_file.flush()
+            if self._fsync == JOURNAL_FSYNC_ALWAYS:
+                os.fsync(self._journal_file.fileno())
+            else:
+                self._journal_dirty = True
+            self._journal_size += len(line)
+            self._bytes_written += len(line)
+
+    def _journal_path(self, gen):
+        return '%s.journal.%s' % (self._path, gen)
+
+    def _delta_path(self, gen):
+        return '%s.delta.%s' % (self._path, gen)
+
+    def _file_gens(self, ext):
+        gens = []
+        dir_path, file_name = os.path.split(self._path)
+        prefix = '%s.%s.' % (file_name, ext)
+        for name in os.listdir(dir_path or '.'):
+            if name.startswith(prefix):
                 try:
-                    self._set_queue.get(timeout=0.01)
-                except Queue.Empty:
+                    gens.append(int(name[len(prefix):]))
+                except ValueError:
                     pass
-            self.export_data()
+        return sorted(gens)
+
+    def _journal_open(self, gen):
+        self._journal_gen = gen
+        self._journal_file = open(self._journal_path(gen), 'a')
+        self._journal_size = 0
+        self._journal_dirty = False
+
+    def _journal_sync(self):
+        with self._journal_lock:
+            if not self._journal_dirty:
+                return
+            self._journal_dirty = False
+            if self._fsync == JOURNAL_FSYNC_EVERYSEC:
+                os.fsync(self._journal_file.fileno())
+
+    def _journal_rotate(self):
+        with self._journal_lock:
+            self._journal_file.flush()
+            if self._fsync != JOURNAL_FSYNC_NEVER:
+                os.fsync(self._journal_file.fileno())
+            self._journal_file.close()
+            self._journal_open(self._journal_gen + 1)
+            return self._journal_gen
+
+    def _replay_journal(self, gen):
+        with open(self._journal_path(gen), 'r') as journal_file:
+            for line in journal_file:
+                try:
+                    method, args = json.loads(line)
+                except ValueError:
+                    # Partial record from an interrupted write
+                    logger.warning('Ignoring truncated cache journal. %r' % {
+                        'path': self._journal_path(gen),
+                    })
+                    break
+                getattr(self, method)(*args)
+
+    def _export_thread(self):
+        journal_size = 0
+        dirty_since = None
+        last_written = self._bytes_written
+        last_time = time.time()
+        while True:
+            time.sleep(JOURNAL_SYNC_INTERVAL)
+            try:
+                self._journal_sync()
+
+                cur_time = time.time()
+                self._bytes_rate = (self._bytes_written - last_written) / \
+                    max(cur_time - last_time, 0.001)
+                last_written = self._bytes_written
+                last_time = cur_time
+
+                # Deltas are held back while writes continue so bursts
+                # coalesce into one export, the staleness bound and the
+                # journal size cap the delay under a steady write load
+                if self._get_dirty_count():
+                    if dirty_since is None:
+                        dirty_since = cur_time
+                    if self._journal_size == journal_size or \
+                            cur_time - dirty_since >= \
+                            SNAPSHOT_MAX_STALENESS or \
+                            self._journal_size >= max(
+                            JOURNAL_REWRITE_MIN_SIZE, self._snapshot_size):
+                        self.export_delta()
+                        dirty_since = None
+                journal_size = self._journal_size
+
+                if self._delta_size >= max(JOURNAL_REWRITE_MIN_SIZE,
+                        self._snapshot_size):
+                    self.rewrite_journal()
+            except:
+                logger.exception('Failed to persist cache journal. %r' % {
+                    'path': self._path,
+                })
+
+    def _get_dirty_count(self):
+        return sum(len(shard.dirty) for shard in self._shards)
+
+    def _clear_dirty(self):
+        for shard in self._shards:
+            shard.dirty = set()
+
+    def _remove_stale(self, journal_gen):
+        for gen in self._file_gens('delta'):
+            if gen <= journal_gen:
+                os.remove(self._delta_path(gen))
+        for gen in self._file_gens('journal'):
+            if gen < journal_gen:
+                os.remove(self._journal_path(gen))
+
+    def export_delta(self):
+        # Write the current value of every key changed since the last
+        # export, removed keys are written as tombstones
+        if not self._journal_file:
+            return
+        with self._snapshot_lock:
+            start = time.time()
+            records = []
+            with self._lock_all():
+                journal_gen = self._journal_rotate()
+                for shard in self._shards:
+                    for key in shard.dirty:
+                        entry = shard.data.get(key)
+                        if entry is None:
+                            records.append((key, None, None, True))
+                        else:
+                            records.append((key, entry.ttl,
+                                self._share(entry), False))
+                    shard.dirty = set()
+            pause = time.time() - start
+
+            delta_path = self._delta_path(journal_gen)
+            temp_path = delta_path + '.tmp'
+            writer = SnapshotWriter(temp_path, journal_gen,
+                self._snapshot_compress)
+            try:
+                for key, ttl, val, removed in records:
+                    if removed:
+                        writer.write_remove(key)
+                    else:
+                        writer.write_key(key, ttl, val)
+            finally:
+                writer.close()
+            os.rename(temp_path, delta_path)
+
+            size = os.path.getsize(delta_path)
+            self._delta_size += size
+            self._bytes_written += size
+            self._deltas_written += 1
+            self._delta_stats = {
+                'keys': len(records),
+                'size': size,
+                'duration': time.time() - start,
+                'pause': pause,
+            }
+
+            for gen in self._file_gens('journal'):
+                if gen < journal_gen:
+                    os.remove(self._journal_path(gen))
+        return journal_gen
+
+    def rewrite_journal(self):
+        with self._snapshot_lock:
+            self._rewrite_journal()
+
+    def _rewrite_journal(self):
+        if self._snapshot_fork:
+            journal_gen = self.export_data(fork=True)
+        else:
+            # Merge the deltas into a new snapshot by loading them into a
+            # separate cache, the live data is never read
+            journal_gen = self.export_delta()
+
+            start = time.time()
+            rewrite_db = Cache()
+            rewrite_db._path = self._path
+            rewrite_db._expire_enabled = False
+            rewrite_db._snapshot_compress = self._snapshot_compress
+            rewrite_db.import_data(journal_gen)
+            rewrite_db.export_data(journal_gen)
+            self._snapshot_stats = {
+                'mode': 'replay',
+                'duration': time.time() - start,
+                'pause': 0,
+            }
+        self._snapshot_size = os.path.getsize(self._path)
+        self._bytes_written += self._snapshot_size
+        self._delta_size = 0
+        self._remove_stale(journal_gen)
+
+    def get_persist_stats(self):
+        return {
+            'dirty_keys': self._get_dirty_count(),
+            'journal_size': self._journal_size,
+            'delta_size': self._delta_size,
+            'deltas_written': self._deltas_written,
+            'snapshot_size': self._snapshot_size,
+            'bytes_written': self._bytes_written,
+            'bytes_per_sec': self._bytes_rate,
+            'export_latency': self._delta_stats.get('duration', 0),
+            'export_pause': self._delta_stats.get('pause', 0),
+        }
 
     def _validate(self, value):
         if value is not None and not isinstance(value, basestring):
             raise TypeError('Value must be string')
 
-    def _check_ttl(self, key):
-        if key not in self._data:
+    def _shard(self, key):
+        return self._shards[hash(key) % len(self._shards)]
+
+    @contextlib.contextmanager
+    def _lock_keys(self, keys):
+        # Shard locks are always acquired in index order to avoid deadlocks
+        # between concurrent multi key operations
+        shards = sorted({hash(key) % len(self._shards) for key in keys})
+        for index in shards:
+            self._shards[index].lock.acquire()
+        try:
+            yield
+        finally:
+            for index in reversed(shards):
+                self._shards[index].lock.release()
+
+    @contextlib.contextmanager
+    def _lock_all(self):
+        for shard in self._shards:
+            shard.lock.acquire()
+        try:
+            yield
+        finally:
+            for shard in reversed(self._shards):
+                shard.lock.release()
+
+    def _get_entry(self, shard, key):
+        # Reads never create entries, expired entries are removed lazily
+        entry = shard.data.get(key)
+        if entry is None:
             return
-        ttl = self._data[key]['ttl']
-        if ttl and int(time.time() * 1000) > ttl:
+        if entry.ttl and int(time.time() * 1000) >= entry.ttl:
             self.remove(key)
+            return
+        if self._max_memory:
+            entry.atime = time.time()
+            entry.freq += 1
+        return entry
+
+    def _set_entry(self, shard, key):
+        if self._journal_file:
+            shard.dirty.add(key)
+        entry = shard.data.get(key)
+        if entry is None:
+            entry = CacheEntry()
+            shard.data[key] = entry
+            shard.keys.add(key)
+        return entry
+
+    def _pop_entry(self, shard, key):
+        if self._journal_file:
+            shard.dirty.add(key)
+        entry = shard.data.pop(key, None)
+        if entry is not None:
+            shard.used -= entry.size
+            if self._indexes:
+                self._index_remove(key, entry.val)
+            shard.keys.remove(key)
+        self._unschedule_expire(key)
+
+    def _share(self, entry):
+        # Readers keep a reference to the container instead of copying it,
+        # the next write copies it once so readers see an unchanged version
+        entry.shared = True
+        return entry.val
+
+    def _own(self, entry):
+        if entry.shared:
+            entry.val = copy.copy(entry.val)
+            entry.shared = False
+        return entry.val
+
+    def _mark_dirty(self, shard, key):
+        if self._journal_file:
+            shard.dirty.add(key)
+
+    def _index_add(self, key, val):
+        if not isinstance(val, dict):
+            return
+        with self._indexes_lock:
+            for field, index in self._indexes.iteritems():
+                if field in val:
+                    index.setdefault(val[field], set()).add(key)
+
+    def _index_remove(self, key, val):
+        if not isinstance(val, dict):
+            return
+        with self._indexes_lock:
+            for field, index in self._indexes.iteritems():
+                if field in val:
+                    keys = index.get(val[field])
+                    if keys is not None:
+                        keys.discard(key)
+                        if not keys:
+                            del index[val[field]]
+
+    def _resize(self, shard, entry, size):
+        shard.used += size - entry.size
+        entry.size = size
+        if self._max_memory:
+            entry.atime = time.time()
+            entry.freq += 1
+
+    def _get_used_memory(self):
+        return sum(shard.used for shard in self._shards)
+
+    def _check_memory(self, key=None):
+        # Transactions check memory once for every call before applying.
+        # Room is made before the write without evicting the written key,
+        # the write is refused when nothing is left to evict
+        if getattr(self._local, 'in_trans', False):
+            return
+        if not self._max_memory:
+            return
+        if self._eviction != CACHE_EVICT_NONE and self._evict(key):
+            return
+        if self._get_used_memory() >= self._max_memory:
+            self._refused += 1
+            raise CacheMemoryError('Cache memory limit reached', {
+                'used_memory': self._get_used_memory(),
+                'max_memory': self._max_memory,
+            })
+
+    def _evict_candidate(self, skip_key):
+        if self._eviction == CACHE_EVICT_VOLATILE_TTL:
+            with self._expire_cond:
+                for ttl_time, key in heapq.nsmallest(CACHE_EVICT_SAMPLES,
+                        self._expire_heap):
+                    if key != skip_key and self._timers.get(key) == ttl_time:
+                        return key
+                timers = [(ttl_time, key) for key, ttl_time in
+                    self._timers.iteritems() if key != skip_key]
+            if timers:
+                return min(timers)[1]
+            return
+
+        # Approximate lru and lfu by sampling keys from a random shard,
+        # keys are sampled from the sorted key chunks so they are not
+        # copied and the next shard is tried when only skip_key is found
+        if self._eviction == CACHE_EVICT_LFU:
+            field = 'freq'
+        else:
+            field = 'atime'
+        start = random.randrange(len(self._shards))
+        for shard in itertools.chain(self._shards[start:],
+                self._shards[:start]):
+            if not shard.data:
+                continue
+            with shard.lock:
+                chunks = shard.keys.chunks
+                if len(shard.data) <= CACHE_EVICT_SAMPLES:
+                    keys = list(shard.data)
+                else:
+                    keys = {random.choice(random.choice(chunks))
+                        for _ in xrange(CACHE_EVICT_SAMPLES)}
+                candidates = [(getattr(shard.data[key], field), key)
+                    for key in keys if key != skip_key]
+                if not candidates and len(shard.data) > 1:
+                    for key in shard.data:
+                        if key != skip_key:
+                            candidates.append((0, key))
+                            break
+            if candidates:
+                return min(candidates)[1]
+
+    def _evict(self, skip_key):
+        # Returns False when the limit is exceeded with no keys to evict
+        if not self._max_memory or self._eviction == CACHE_EVICT_NONE:
+            return True
+        # Transactions hold their shard locks, evict once they are released
+        if getattr(self._local, 'in_trans', False):
             return True
-        return False
+        while self._get_used_memory() > self._max_memory:
+            key = self._evict_candidate(skip_key)
+            if key is None:
+                return False
+            self.remove(key)
+            self._evicted += 1
+        return True
+
+    def set_max_memory(self, max_memory, eviction=CACHE_EVICT_LRU):
+        if eviction not in (CACHE_EVICT_LRU, CACHE_EVICT_LFU,
+                CACHE_EVICT_VOLATILE_TTL, CACHE_EVICT_NONE):
+            raise CacheError('Unknown cache eviction policy', {
+                'eviction': eviction,
+            })
+        self._max_memory = max_memory
+        self._eviction = eviction
+        self._evict(None)
+
+    def get_memory_stats(self):
+        return {
+            'used_memory': self._get_used_memory(),
+            'max_memory': self._max_memory,
+            'eviction': self._eviction,
+            'evicted': self._evicted,
+            'refused': self._refused,
+        }
+
+    def _schedule_expire(self, key, ttl_time):
+        with self._expire_cond:
+            self._timers[key] = ttl_time
+            heapq.heappush(self._expire_heap, (ttl_time, key))
+
+            # Drop stale entries left behind by keys that were re-expired
+            # or removed once they outnumber the live timers
+            if len(self._expire_heap) > (len(self._timers) * 2) + 64:
+                self._expire_heap = [(value, key) for key, value in
+                    self._timers.iteritems()]
+                heapq.heapify(self._expire_heap)
+
+            self._wake_expire(key)
+
+    def _schedule_expires(self, timers):
+        # Imported timers are added at once and the heap is rebuilt
+        with self._expire_cond:
+            self._timers.update(timers)
+            self._expire_heap = [(value, key) for key, value in
+                self._timers.iteritems()]
+            heapq.heapify(self._expire_heap)
+            self._wake_expire(None)
+
+    def _wake_expire(self, key):
+        if self._expire_enabled and not self._expire_thread_started:
+            self._expire_thread_started = True
+            thread = threading.Thread(target=self._expire_thread)
+            thread.daemon = True
+            thread.start()
+        elif key is None or self._expire_heap[0][1] == key:
+            self._expire_cond.notify()
+
+    def _unschedule_expire(self, key):
+        with self._expire_cond:
+            self._timers.pop(key, None)
+
+    def _expire_thread(self):
+        while True:
+            with self._expire_cond:
+                while True:
+                    if not self._expire_heap:
+                        self._expire_cond.wait()
+                        continue
+                    ttl_time, key = self._expire_heap[0]
+                    wait = (ttl_time - int(time.time() * 1000)) / 1000.0
+                    if wait <= 0:
+                        heapq.heappop(self._expire_heap)
+                        if self._timers.get(key) == ttl_time:
+                            break
+                        continue
+                    self._expire_cond.wait(wait)
 
-    def _check_ttl_timer(self, key):
-        self._timers.pop(key, None)
-        self._check_ttl(key)
+            shard = self._shard(key)
+            with shard.lock:
+                self._get_entry(shard, key)
 
-    def setup_persist(self, path):
+    def setup_persist(self, path, fsync=JOURNAL_FSYNC_EVERYSEC,
+            snapshot_fork=False, snapshot_compress=True):
         self._path = path
-        persist_db.import_data()
-        threading.Thread(target=self._export_thread).start()
+        self._fsync = fsync
+        self._snapshot_fork = snapshot_fork
+        self._snapshot_compress = snapshot_compress
+        self.import_data()
+
+        # Never append to a replayed journal, it may end in a partial record
+        gens = self._file_gens('journal')
+        self._journal_open(gens[-1] + 1 if gens else 0)
+
+        thread = threading.Thread(target=self._export_thread)
+        thread.daemon = True
+        thread.start()
 
     def get(self, key):
-        if self._check_ttl(key) is False:
-            return self._data[key]['val']
+        shard = self._shard(key)
+        with shard.lock:
+            entry = self._get_entry(shard, key)
+            if entry is not None:
+                return entry.val
 
     def set(self, key, value):
         self._validate(value)
-        self._data[key]['val'] = value
-        self._put_queue()
+        self._check_memory(key)
+        shard = self._shard(key)
+        with shard.lock:
+            entry = self._set_entry(shard, key)
+            if self._indexes:
+                self._index_remove(key, entry.val)
+            entry.val = value
+            self._resize(shard, entry, _entry_size(key, value))
+            self._journal('set', key, value)
+        self._evict(key)
 
     def increment(self, key):
-        if key not in self._data:
-            self._data[key]['val'] = '1'
-        else:
+        self._check_memory(key)
+        shard = self._shard(key)
+        with shard.lock:
+            entry = self._get_entry(shard, key)
             try:
-                self._data[key]['val'] = str(int(self.get(key)) + 1)
-            except (TypeError, ValueError):
-                self._data[key]['val'] = '1'
-        self._put_queue()
+                value = str(int(entry.val) + 1)
+            except (AttributeError, TypeError, ValueError):
+                value = '1'
+            entry = self._set_entry(shard, key)
+            if self._indexes:
+                self._index_remove(key, entry.val)
+            entry.val = value
+            self._resize(shard, entry, _entry_size(key, value))
+            self._journal('increment', key)
+        self._evict(key)
 
     def decrement(self, key):
-        if key not in self._data:
-            self._data[key]['val'] = '0'
-        else:
+        self._check_memory(key)
+        shard = self._shard(key)
+        with shard.lock:
+            entry = self._get_entry(shard, key)
             try:
-                self._data[key]['val'] = str(int(self.get(key)) - 1)
-            except (TypeError, ValueError):
-                self._data[key]['val'] = '0'
-        self._put_queue()
+                value = str(int(entry.val) - 1)
+            except (AttributeError, TypeError, ValueError):
+                value = '0'
+            entry = self._set_entry(shard, key)
+            if self._indexes:
+                self._index_remove(key, entry.val)
+            entry.val = value
+            self._resize(shard, entry, _entry_size(key, value))
+            self._journal('decrement', key)
+        self._evict(key)
 
     def remove(self, key):
-        self._data.pop(key, None)
-        self._put_queue()
+        shard = self._shard(key)
+        with shard.lock:
+            self._pop_entry(shard, key)
+            self._journal('remove', key)
 
     def rename(self, key, new_key):
-        if self._check_ttl(key) is False:
-            self._data[new_key]['val'] = self._data[key]['val']
-        self.remove(key)
-        self._put_queue()
+        shard = self._shard(key)
+        new_shard = self._shard(new_key)
+        with self._lock_keys((key, new_key)):
+            entry = self._get_entry(shard, key)
+            if entry is not None:
+                new_entry = self._set_entry(new_shard, new_key)
+                if self._indexes:
+                    self._index_remove(new_key, new_entry.val)
+                # Readers of the old key may still hold the container
+                new_entry.val = entry.val
+                new_entry.shared = entry.shared
+                self._resize(new_shard, new_entry,
+                    entry.size + len(new_key) - len(key))
+            self._pop_entry(shard, key)
+            if entry is not None and self._indexes:
+                self._index_add(new_key, entry.val)
+            self._journal('rename', key, new_key)
 
     def exists(self, key):
-        if self._check_ttl(key) is False:
-            return True
-        return False
+        shard = self._shard(key)
+        with shard.lock:
+            return self._get_entry(shard, key) is not None
 
     def expire(self, key, ttl):
-        ttl_time = int(time.time() * 1000) + (ttl * 1000)
+        self.expire_at(key, int(time.time() * 1000) + (ttl * 1000))
 
-        cur_timer = self._timers.pop(key, None)
-        timer = threading.Timer(ttl + 0.01, self._check_ttl_timer, (key,))
-        self._timers[key] = timer
-        if cur_timer:
-            cur_timer.cancel()
-        timer.start()
-
-        self._data[key]['ttl'] = ttl_time
-        self._put_queue()
+    def expire_at(self, key, ttl_time):
+        shard = self._shard(key)
+        with shard.lock:
+            self._set_entry(shard, key).ttl = ttl_time
+            self._schedule_expire(key, ttl_time)
+            self._journal('expire_at', key, ttl_time)
 
     def set_add(self, key, element):
         self._validate(element)
-        if key not in self._data:
-            self._data[key]['val'] = {element}
-        else:
+        self._check_memory(key)
+        shard = self._shard(key)
+        with shard.lock:
+            entry = self._set_entry(shard, key)
             try:
-                self._data[key]['val'].add(element)
-            except AttributeError:
-                self._data[key]['val'] = {element}
-        self._put_queue()
+                if element not in entry.val:
+                    self._own(entry).add(element)
+                    self._resize(shard, entry,
+                        entry.size + _elem_size(element))
+            except (TypeError, AttributeError):
+                if self._indexes:
+                    self._index_remove(key, entry.val)
+                entry.val = {element}
+                self._resize(shard, entry, _entry_size(key, entry.val))
+            self._journal('set_add', key, element)
+        self._evict(key)
 
     def set_remove(self, key, element):
-        try:
-            self._data[key]['val'].remove(element)
-        except (KeyError, AttributeError):
-            pass
-        self._put_queue()
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.data.get(key)
+            if entry is not None:
+                try:
+                    self._own(entry).remove(element)
+                    self._mark_dirty(shard, key)
+                    self._resize(shard, entry,
+                        entry.size - _elem_size(element))
+                except (KeyError, AttributeError):
+                    pass
+            self._journal('set_remove', key, element)
 
     def set_exists(self, key, element):
-        if self._check_ttl(key) is False:
-            try:
-                return element in self._data[key]['val']
-            except (TypeError, AttributeError):
-                pass
-        return False
+        shard = self._shard(key)
+        with shard.lock:
+            entry = self._get_entry(shard, key)
+            if entry is not None:
+                try:
+                    return element in entry.val
+                except (TypeError, AttributeError):
+                    pass
+            return False
 
     def set_elements(self, key):
-        if self._check_ttl(key) is False:
-            try:
-                return self._data[key]['val'].copy()
-            except AttributeError:
-                pass
-        return set()
+        shard = self._shard(key)
+        with shard.lock:
+            entry = self._get_entry(shard, key)
+            if entry is not None:
+                try:
+                    return entry.val.copy()
+                except AttributeError:
+                    pass
+            return set()
+
+    def set_iter(self, key):
+        shard = self._shard(key)
+        with shard.lock:
+            values = None
+            entry = self._get_entry(shard, key)
+            if entry is not None and isinstance(entry.val, set):
+                values = self._share(entry)
+        if values:
+            for value in values:
+                yield value
 
     def list_lpush(self, key, value):
         self._validate(value)
-        if key not in self._data:
-            self._data[key]['val'] = collections.deque([value])
-        else:
+        self._check_memory(key)
+        shard = self._shard(key)
+        with shard.lock:
+            entry = self._set_entry(shard, key)
             try:
-                self._data[key]['val'].appendleft(value)
+                self._own(entry).appendleft(value)
+                self._resize(shard, entry, entry.size + _elem_size(value))
             except AttributeError:
-                self._data[key]['val'] = collections.deque([value])
-        self._put_queue()
+                if self._indexes:
+                    self._index_remove(key, entry.val)
+                entry.val = collections.deque([value])
+                self._resize(shard, entry, _entry_size(key, entry.val))
+            self._journal('list_lpush', key, value)
+        self._evict(key)
 
     def list_rpush(self, key, value):
         self._validate(value)
-        if key not in self._data:
-            self._data[key]['val'] = collections.deque([value])
-        else:
+        self._check_memory(key)
+        shard = self._shard(key)
+        with shard.lock:
+            entry = self._set_entry(shard, key)
             try:
-                self._data[key]['val'].append(value)
+                self._own(entry).append(value)
+                self._resize(shard, entry, entry.size + _elem_size(value))
             except AttributeError:
-                self._data[key]['val'] = collections.deque([value])
-        self._put_queue()
+                if self._indexes:
+                    self._index_remove(key, entry.val)
+                entry.val = collections.deque([value])
+                self._resize(shard, entry, _entry_size(key, entry.val))
+            self._journal('list_rpush', key, value)
+        self._evict(key)
 
     def list_lpop(self, key):
         data = None
-        if self._check_ttl(key) is False:
-            try:
-                data = self._data[key]['val'].popleft()
-            except (AttributeError, IndexError):
-                pass
-        if data:
-            self._put_queue()
-            return data
+        shard = self._shard(key)
+        with shard.lock:
+            entry = self._get_entry(shard, key)
+            if entry is not None:
+                try:
+                    data = self._own(entry).popleft()
+                    self._mark_dirty(shard, key)
+                    self._resize(shard, entry, entry.size - _elem_size(data))
+                except (AttributeError, IndexError):
+                    pass
+            if data:
+                self._journal('list_lpop', key)
+                return data
 
     def list_rpop(self, key):
         data = None
-        if self._check_ttl(key) is False:
-            try:
-                data = self._data[key]['val'].pop()
-            except (AttributeError, IndexError):
-                pass
-        if data:
-            self._put_queue()
-            return data
+        shard = self._shard(key)
+        with shard.lock:
+            entry = self._get_entry(shard, key)
+            if entry is not None:
+                try:
+                    data = self._own(entry).pop()
+                    self._mark_dirty(shard, key)
+                    self._resize(shard, entry, entry.size - _elem_size(data))
+                except (AttributeError, IndexError):
+                    pass
+            if data:
+                self._journal('list_rpop', key)
+                return data
 
     def list_index(self, key, index):
-        if self._check_ttl(key) is False:
-            try:
-                return self._data[key]['val'][index]
-            except (AttributeError, IndexError):
-                pass
+        shard = self._shard(key)
+        with shard.lock:
+            entry = self._get_entry(shard, key)
+            if entry is not None:
+                try:
+                    return entry.val[index]
+                except (AttributeError, IndexError, TypeError):
+                    pass
 
     def list_elements(self, key):
-        if self._check_ttl(key) is False:
-            try:
-                return list(self._data[key]['val'])
-            except TypeError:
-                pass
-        return []
+        shard = self._shard(key)
+        with shard.lock:
+            entry = self._get_entry(shard, key)
+            if entry is not None:
+                try:
+                    return list(entry.val)
+                except TypeError:
+                    pass
+            return []
 
     def list_iter(self, key):
-        if self._check_ttl(key) is False:
-            try:
-                for value in copy.copy(self._data[key]['val']):
-                    yield value
-            except TypeError:
-                pass
+        shard = self._shard(key)
+        with shard.lock:
+            values = None
+            entry = self._get_entry(shard, key)
+            if entry is not None:
+                values = self._share(entry)
+        if values:
+            for value in values:
+                yield value
 
     def list_iter_range(self, key, start, stop=None):
-        if self._check_ttl(key) is False:
-            try:
-                for value in itertools.islice(
-                        copy.copy(self._data[key]['val']), start, stop):
-                    yield value
-            except TypeError:
-                pass
+        shard = self._shard(key)
+        with shard.lock:
+            values = None
+            entry = self._get_entry(shard, key)
+            if entry is not None:
+                values = self._share(entry)
+        if values:
+            for value in itertools.islice(values, start, stop):
+                yield value
 
     def list_remove(self, key, value, count=0):
         self._validate(value)
-        def _remove():
-            try:
-                self._data[key]['val'].remove(value)
-            except (AttributeError, ValueError):
-                return True
-
-        if count:
-            for i in xrange(count):
-                if _remove():
-                    break
-        else:
-            while True:
-                if _remove():
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.data.get(key)
+            i = 0
+            while entry is not None and (not count or i < count):
+                try:
+                    self._own(entry).remove(value)
+                except (AttributeError, ValueError):
                     break
-        self._put_queue()
+                self._mark_dirty(shard, key)
+                self._resize(shard, entry, entry.size - _elem_size(value))
+                i += 1
+            self._journal('list_remove', key, value, count)
 
     def list_length(self, key):
-        if self._check_ttl(key) is False:
-            try:
-                return len(self._data[key]['val'])
-            except TypeError:
-                pass
-        return 0
+        shard = self._shard(key)
+        with shard.lock:
+            entry = self._get_entry(shard, key)
+            if entry is not None:
+                try:
+                    return len(entry.val)
+                except TypeError:
+                    pass
+            return 0
 
     def dict_get(self, key, field):
-        if self._check_ttl(key) is False:
-            try:
-                return self._data[key]['val'][field]
-            except (TypeError, KeyError):
-                pass
+        shard = self._shard(key)
+        with shard.lock:
+            entry = self._get_entry(shard, key)
+            if entry is not None:
+                try:
+                    return entry.val[field]
+                except (TypeError, KeyError):
+                    pass
 
     def dict_set(self, key, field, value):
         self._validate(value)
-        if key not in self._data:
-            self._data[key]['val'] = {field: value}
-        else:
+        self._check_memory(key)
+        shard = self._shard(key)
+        with shard.lock:
+            entry = self._set_entry(shard, key)
+            if self._indexes:
+                self._index_remove(key, entry.val)
             try:
-                self._data[key]['val'][field] = value
-            except TypeError:
-                self._data[key]['val'] = {field: value}
-        self._put_queue()
+                if field in entry.val:
+                    size = entry.size + _elem_size(value) - \
+                        _elem_size(entry.val[field])
+                else:
+                    size = entry.size + _elem_size(field) + \
+                        _elem_size(value)
+                self._own(entry)[field] = value
+                self._resize(shard, entry, size)
+            except (TypeError, AttributeError):
+                entry.val = {field: value}
+                self._resize(shard, entry, _entry_size(key, entry.val))
+            if self._indexes:
+                self._index_add(key, entry.val)
+            self._journal('dict_set', key, field, value)
+        self._evict(key)
 
     def dict_remove(self, key, field):
-        try:
-            self._data[key]['val'].pop(field, None)
-        except AttributeError:
-            pass
-        self._put_queue()
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.data.get(key)
+            if entry is not None:
+                try:
+                    if field in entry.val:
+                        if self._indexes:
+                            self._index_remove(key, entry.val)
+                        value = self._own(entry).pop(field)
+                        if self._indexes:
+                            self._index_add(key, entry.val)
+                        self._mark_dirty(shard, key)
+                        self._resize(shard, entry, entry.size -
+                            _elem_size(field) - _elem_size(value))
+                except (TypeError, AttributeError):
+                    pass
+            self._journal('dict_remove', key, field)
 
     def dict_keys(self, key):
-        if self._check_ttl(key) is False:
-            try:
-                return set(self._data[key]['val'].keys())
-            except AttributeError:
-                pass
-        return set()
+        shard = self._shard(key)
+        with shard.lock:
+            entry = self._get_entry(shard, key)
+            if entry is not None:
+                try:
+                    return set(entry.val.keys())
+                except AttributeError:
+                    pass
+            return set()
 
     def dict_get_all(self, key):
-        if self._check_ttl(key) is False:
-            try:
-                return self._data[key]['val'].copy()
-            except AttributeError:
-                pass
-        return {}
+        shard = self._shard(key)
+        with shard.lock:
+            entry = self._get_entry(shard, key)
+            if entry is not None:
+                try:
+                    return entry.val.copy()
+                except AttributeError:
+                    pass
+            return {}
 
-    def subscribe(self, channel, timeout=None):
-        event = threading.Event()
-        self._channels[channel]['subs'].add(event)
-        try:
-            cursor = self._channels[channel]['msgs'][-1][0]
-        except IndexError:
-            cursor = None
-        while True:
-            if not event.wait(timeout):
-                break
-            event.clear()
-            if not cursor:
-                cursor_found = True
-            else:
-                cursor_found = False
-            messages = copy.copy(self._channels[channel]['msgs'])
-            for message in messages:
-                if cursor_found:
-                    yield message[1]
-                elif message[0] == cursor:
-                    cursor_found = True
-            cursor = messages[-1][0]
+    def dict_iter(self, key):
+        shard = self._shard(key)
+        with shard.lock:
+            values = None
+            entry = self._get_entry(shard, key)
+            if entry is not None and isinstance(entry.val, dict):
+                values = self._share(entry)
+        if values:
+            for item in values.iteritems():
+                yield item
+
+    def _subscribe(self, channel, watch, subscriber_cls, *args):
+        with self._channels_lock:
+            cache_channel = self._channels.get(channel)
+            if not cache_channel:
+                cache_channel = CacheChannel(channel)
+                self._channels[channel] = cache_channel
+            subscriber = subscriber_cls(self, cache_channel, *args)
+            cache_channel.subscribe(subscriber)
+
+            # Watches are replaced rather than modified so mutations can
+            # read them without a lock
+            if watch and channel not in self._watches:
+                watches = self._watches.copy()
+                watches[channel] = watch
+                self._watches = watches
+        return subscriber
+
+    def subscribe(self, channel, timeout=None, queue_max=SUB_QUEUE_MAX,
+            overflow=SUB_OVERFLOW_DROP_OLDEST):
+        # Registers before returning so messages published before the first
+        # iteration are not missed, iterating ends on timeout
+        return self._subscribe(channel, None, CacheSubscriber, timeout,
+            queue_max, overflow)
+
+    def subscribe_async(self, channel, callback, timeout=None,
+            queue_max=SUB_QUEUE_MAX, overflow=SUB_OVERFLOW_DROP_OLDEST):
+        # Runs the callback on the current ioloop for each message and with
+        # None once the timeout expires, returns the subscriber which is
+        # stopped with cancel
+        return self._subscribe(channel, None, CacheAsyncSubscriber, timeout,
+            queue_max, overflow, callback)
+
+    def subscribe_future(self, channel, timeout=None):
+        # Returns a future resolved on the current ioloop with the next
+        # message or with None once the timeout expires
+        future = tornado.concurrent.Future()
+
+        def on_message(message):
+            subscriber.cancel()
+            if not future.done():
+                future.set_result(message)
+        subscriber = self.subscribe_async(channel, on_message, timeout)
+        return future
+
+    def watch(self, key, prefix=False, callback=None, timeout=None,
+            queue_max=SUB_QUEUE_MAX, overflow=SUB_OVERFLOW_DROP_OLDEST):
+        # Subscribe to changes of a key or of every key starting with the
+        # prefix, each message is a (key, method) tuple
+        if prefix:
+            channel = CACHE_KEYPREFIX_CHANNEL % key
+        else:
+            channel = CACHE_KEYSPACE_CHANNEL % key
+        if callback:
+            return self._subscribe(channel, (key, prefix),
+                CacheAsyncSubscriber, timeout, queue_max, overflow, callback)
+        return self._subscribe(channel, (key, prefix), CacheSubscriber,
+            timeout, queue_max, overflow)
+
+    def _notify(self, method, args):
+        if method == '_apply_calls':
+            # Each call in the transaction notifies separately
+            return
+        elif method == 'mset':
+            keys = args[0]
+        elif method == 'rename':
+            keys = args[:2]
+        else:
+            keys = args[:1]
+
+        for channel, (pattern, prefix) in self._watches.iteritems():
+            for key in keys:
+                if key == pattern or (prefix and key.startswith(pattern)):
+                    self.publish(channel, (key, method))
+
+    def _unsubscribe(self, cache_channel, subscriber):
+        with self._channels_lock:
+            cache_channel.unsubscribe(subscriber)
+            # Reclaim the channel once its last subscriber has left, a
+            # later subscribe creates a new one
+            if not cache_channel.subs and self._channels.get(
+                    cache_channel.name) is cache_channel:
+                del self._channels[cache_channel.name]
+                self._channels_reclaimed += 1
+                if cache_channel.name in self._watches:
+                    watches = self._watches.copy()
+                    del watches[cache_channel.name]
+                    self._watches = watches
 
     def publish(self, channel, message):
-        self._channels[channel]['msgs'].append(
-            (uuid.uuid4().hex, message))
-        for subscriber in self._channels[channel]['subs'].copy():
-            subscriber.set()
+        cache_channel = self._channels.get(channel)
+        if cache_channel:
+            cache_channel.publish(message)
+
+    def get_channel_stats(self, channel):
+        cache_channel = self._channels.get(channel)
+        if not cache_channel:
+            return {
+                'seq': 0,
+                'subscribers': 0,
+                'dropped': 0,
+            }
+        with cache_channel.lock:
+            return {
+                'seq': cache_channel.seq,
+                'subscribers': len(cache_channel.subs),
+                'dropped': cache_channel.dropped,
+            }
+
+    def _find_deadlock(self, ident, key):
+        # Follow the wait for graph from the holders of the lock, a path
+        # that leads back to the waiting thread is a deadlock
+        visited = set()
+        stack = [(key, [key])]
+        while stack:
+            lock_key, path = stack.pop()
+            cache_lock = self._locks.get(lock_key)
+            if not cache_lock:
+                continue
+            for holder in cache_lock.holders():
+                if holder == ident:
+                    return path
+                if holder in visited:
+                    continue
+                visited.add(holder)
+                wait_key = self._lock_waits.get(holder)
+                if wait_key is not None:
+                    stack.append((wait_key, path + [wait_key]))
+
+    def _new_wait_stats(self):
+        return {
+            'count': 0,
+            'total': 0,
+            'max': 0,
+            'histogram': [0] * (len(CACHE_LOCK_WAIT_BUCKETS) + 1),
+        }
+
+    def _record_wait(self, key, wait):
+        # Only the most recently contended keys are kept, lock keys are
+        # per server so the stats of older keys are folded into other
+        stats = self._lock_contention.pop(key, None)
+        if not stats:
+            stats = self._new_wait_stats()
+            if len(self._lock_contention) >= CACHE_LOCK_CONTENTION_MAX:
+                other = self._lock_contention_other
+                old_stats = self._lock_contention.popitem(last=False)[1]
+                other['count'] += old_stats['count']
+                other['total'] += old_stats['total']
+                other['max'] = max(other['max'], old_stats['max'])
+                for i, count in enumerate(old_stats['histogram']):
+                    other['histogram'][i] += count
+        self._lock_contention[key] = stats
+        stats['count'] += 1
+        stats['total'] += wait
+        stats['max'] = max(stats['max'], wait)
+        stats['histogram'][bisect.bisect_left(CACHE_LOCK_WAIT_BUCKETS,
+            wait * 1000)] += 1
+
+    def lock_acquire(self, key, timeout=None, shared=False):
+        ident = thread.get_ident()
+        with self._locks_lock:
+            cache_lock = self._locks.get(key)
+            if not cache_lock:
+                cache_lock = CacheLock(key, self._locks_lock)
+                self._locks[key] = cache_lock
+            # Locks are reference counted by holders and waiters and
+            # reclaimed once unused
+            cache_lock.refs += 1
+
+            start = None
+            while not cache_lock.available(ident, shared):
+                if start is None:
+                    start = time.time()
+                    cycle = self._find_deadlock(ident, key)
+                    if cycle:
+                        self._lock_deadlocks += 1
+                        self._lock_unref(cache_lock)
+                        logger.error('Cache lock deadlock detected. %r' % {
+                            'key': key,
+                            'cycle': cycle,
+                            'thread': threading.current_thread().name,
+                        })
+                        raise CacheDeadlockError(
+                            'Cache lock deadlock detected', {
+                                'key': key,
+                                'cycle': cycle,
+                            })
+                    self._lock_waits[ident] = key
+                    if not shared:
+                        cache_lock.writers_waiting += 1
+
+                remaining = None
+                if timeout is not None:
+                    remaining = start + timeout - time.time()
+                    if remaining <= 0:
+                        self._lock_timeouts += 1
+                        self._record_wait(key, time.time() - start)
+                        self._lock_waits.pop(ident, None)
+                        if not shared:
+                            cache_lock.writers_waiting -= 1
+                        self._lock_unref(cache_lock)
+                        cache_lock.cond.notify_all()
+                        return False
+                cache_lock.cond.wait(remaining)
+
+            if start is not None:
+                self._record_wait(key, time.time() - start)
+                self._lock_waits.pop(ident, None)
+                if not shared:
+                    cache_lock.writers_waiting -= 1
+            cache_lock.grant(ident, shared)
+            self._lock_acquired += 1
+        return True
 
-    def lock_acquire(self, key):
-        return self._locks[key].acquire()
+    def _lock_unref(self, cache_lock):
+        cache_lock.refs -= 1
+        if cache_lock.refs <= 0 and self._locks.get(
+                cache_lock.key) is cache_lock:
+            del self._locks[cache_lock.key]
+            self._locks_reclaimed += 1
 
     def lock_release(self, key):
+        with self._locks_lock:
+            cache_lock = self._locks.get(key)
+            if not cache_lock or not cache_lock.release(thread.get_ident()):
+                raise CacheLockError('Cache lock is not held', {
+                    'key': key,
+                })
+            self._lock_unref(cache_lock)
+            cache_lock.cond.notify_all()
+
+    def lock_remove(self, key):
+        # Unused locks are already reclaimed, only release a held lock
         try:
-            self._locks[key].release()
-        except thread.error:
+            self.lock_release(key)
+        except CacheLockError:
             pass
 
-    def lock_remove(self, key):
-        self.lock_release(key)
-        self._locks.pop(key, None)
+    def get_lock_stats(self):
+        cur_time = time.time()
+        with self._locks_lock:
+            locks = {}
+            for key, cache_lock in self._locks.iteritems():
+                readers = sum(cache_lock.readers.itervalues())
+                locks[key] = {
+                    'owner': cache_lock.owner_name,
+                    'held': cur_time - cache_lock.owner_time
+                        if cache_lock.owner_time else 0,
+                    'readers': readers,
+                    'waiting': cache_lock.refs - readers - (
+                        1 if cache_lock.owner is not None else 0),
+                }
+            return {
+                'acquired': self._lock_acquired,
+                'timeouts': self._lock_timeouts,
+                'deadlocks': self._lock_deadlocks,
+                'wait_buckets': CACHE_LOCK_WAIT_BUCKETS,
+                'locks': locks,
+                'contention': copy.deepcopy(dict(self._lock_contention)),
+                'contention_other': copy.deepcopy(
+                    self._lock_contention_other),
+            }
+
+    def get_gc_stats(self):
+        with self._channels_lock:
+            channels = len(self._channels)
+        with self._locks_lock:
+            locks = len(self._locks)
+        return {
+            'channels': channels,
+            'channels_reclaimed': self._channels_reclaimed,
+            'locks': locks,
+            'locks_reclaimed': self._locks_reclaimed,
+        }
+
+    def mget(self, keys):
+        keys = list(keys)
+        values = []
+        with self._lock_keys(keys):
+            for key in keys:
+                entry = self._get_entry(self._shard(key), key)
+                values.append(entry.val if entry is not None else None)
+        return values
+
+    def mset(self, values):
+        for value in values.itervalues():
+            self._validate(value)
+        self._check_memory()
+        with self._lock_keys(values):
+            for key, value in values.iteritems():
+                shard = self._shard(key)
+                entry = self._set_entry(shard, key)
+                if self._indexes:
+                    self._index_remove(key, entry.val)
+                entry.val = value
+                self._resize(shard, entry, _entry_size(key, value))
+            self._journal('mset', values)
+        self._evict(None)
+
+    def dict_set_many(self, key, values):
+        for value in values.itervalues():
+            self._validate(value)
+        self._check_memory(key)
+        shard = self._shard(key)
+        with shard.lock:
+            entry = self._set_entry(shard, key)
+            if self._indexes:
+                self._index_remove(key, entry.val)
+            if not isinstance(entry.val, dict):
+                entry.val = {}
+                self._resize(shard, entry, _entry_size(key, entry.val))
+
+            size = entry.size
+            val = self._own(entry)
+            for field, value in values.iteritems():
+                if field in val:
+                    size += _elem_size(value) - _elem_size(val[field])
+                else:
+                    size += _elem_size(field) + _elem_size(value)
+                val[field] = value
+            self._resize(shard, entry, size)
+            if self._indexes:
+                self._index_add(key, entry.val)
+            self._journal('dict_set_many', key, values)
+        self._evict(key)
+
+    def scan(self, prefix='', cursor=None, count=CACHE_SCAN_COUNT):
+        # The cursor is the last key returned so iteration continues in
+        # order when keys are added or removed between calls, a cursor of
+        # None is returned once no keys are left
+        if count < 1:
+            raise ValueError('Scan count must be positive')
+        # Each shard keeps its own sorted keys, the next keys of every
+        # shard are merged so key creation is not serialized across shards
+        shard_keys = []
+        for shard in self._shards:
+            keys = []
+            with shard.lock:
+                if cursor is None:
+                    key_iter = shard.keys.iter_from(prefix)
+                else:
+                    key_iter = shard.keys.iter_from(cursor, False)
+                for key in key_iter:
+                    if not key.startswith(prefix) or len(keys) > count:
+                        break
+                    keys.append(key)
+            if keys:
+                shard_keys.append(keys)
+
+        keys = list(itertools.islice(heapq.merge(*shard_keys), count + 1))
+        if len(keys) > count:
+            keys = keys[:count]
+            return keys[-1], keys
+        return None, keys
+
+    def scan_iter(self, prefix='', count=CACHE_SCAN_COUNT):
+        cursor = None
+        while True:
+            cursor, keys = self.scan(prefix, cursor, count)
+            for key in keys:
+                yield key
+            if cursor is None:
+                break
+
+    def create_index(self, field):
+        # Index the value of a dict field across all keys so find does not
+        # need to read every key
+        with self._indexes_lock:
+            if field in self._indexes:
+                return
+            self._indexes[field] = {}
+        for shard in self._shards:
+            with shard.lock:
+                for key, entry in shard.data.iteritems():
+                    if isinstance(entry.val, dict) and field in entry.val:
+                        with self._indexes_lock:
+                            self._indexes[field].setdefault(
+                                entry.val[field], set()).add(key)
+
+    def drop_index(self, field):
+        with self._indexes_lock:
+            self._indexes.pop(field, None)
+
+    def find(self, field, value):
+        with self._indexes_lock:
+            index = self._indexes.get(field)
+            if index is None:
+                raise CacheIndexError('Cache field is not indexed', {
+                    'field': field,
+                })
+            return set(index.get(value, ()))
 
     def transaction(self):
         return CacheTransaction(self)
 
+    def pipeline(self):
+        return CachePipeline(self)
+
+    def _apply_calls(self, calls):
+        keys = set()
+        for call in calls:
+            if call[0] == 'mset':
+                keys.update(_call_arg(call, 0, 'values'))
+            else:
+                keys.add(_call_arg(call, 0, 'key'))
+            if call[0] == 'rename':
+                keys.add(_call_arg(call, 1, 'new_key'))
+
+        # Hold every shard the calls touch so they are applied atomically
+        # and journaled as a single record. Memory is checked once for the
+        # whole batch before the shards are locked since making room
+        # removes keys from other shards, only the calls that were applied
+        # are journaled so a replay matches memory when a call fails.
+        self._check_memory()
+        with self._lock_keys(keys):
+            applied = 0
+            self._local.in_trans = True
+            try:
+                for call in calls:
+                    getattr(self, call[0])(*call[1], **call[2])
+                    applied += 1
+            finally:
+                self._local.in_trans = False
+                if applied:
+                    self._journal('_apply_calls', calls[:applied])
+        self._evict(None)
+
     def _apply_trans(self, trans):
-        for call in trans[1]:
-            getattr(self, call[0])(*call[1], **call[2])
         try:
-            self._commit_log.remove(trans)
-        except ValueError:
-            pass
-        self._put_queue()
+            self._apply_calls(trans[1])
+        finally:
+            try:
+                self._commit_log.remove(trans)
+            except ValueError:
+                pass
 
-    def export_data(self):
-        if not self._path:
-            return
+    def _write_snapshot(self, journal_gen, locked=True):
+        # Transactions are journaled so the commit log is not exported,
+        # it is only read from older snapshots
         temp_path = self._path + '.tmp'
         try:
-            data = self._data.copy()
-            timers = self._timers.keys()
-            commit_log = copy.copy(self._commit_log)
-
-            with open(temp_path, 'w') as db_file:
-                export_data = []
-
-                for key in data:
-                    key_ttl = data[key]['ttl']
-                    key_val = data[key]['val']
-                    key_type = type(key_val).__name__
-                    if key_type == 'set' or key_type == 'deque':
-                        key_val = list(key_val)
-                    export_data.append((key, key_type, key_ttl, key_val))
-
-                db_file.write(json.dumps({
-                    'ver': 1,
-                    'data': export_data,
-                    'timers': timers,
-                    'commit_log': commit_log,
-                }))
+            writer = SnapshotWriter(temp_path, journal_gen,
+                self._snapshot_compress)
+            try:
+                for shard in self._shards:
+                    if locked:
+                        shard.lock.acquire()
+                    try:
+                        for key, entry in shard.data.iteritems():
+                            writer.write_key(key, entry.ttl, entry.val)
+                    finally:
+                        if locked:
+                            shard.lock.release()
+            finally:
+                writer.close()
             os.rename(temp_path, self._path)
         except:
+            exc_info = sys.exc_info()
             try:
                 os.remove(temp_path)
             except OSError:
                 pass
-            raise
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _fork_snapshot(self):
+        # Fork while every shard is locked and the journal is rotated so
+        # the child serializes a consistent copy on write view of the data
+        # while the parent continues serving writes
+        start = time.time()
+        with self._lock_all():
+            journal_gen = self._journal_rotate() if self._journal_file else 0
+            self._clear_dirty()
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    self._write_snapshot(journal_gen, False)
+                except:
+                    os._exit(1)
+                os._exit(0)
+        pause = time.time() - start
+
+        status = os.waitpid(pid, 0)[1]
+        self._snapshot_stats = {
+            'mode': 'fork',
+            'duration': time.time() - start,
+            'pause': pause,
+        }
+        if status != 0:
+            raise CacheSnapshotError('Cache snapshot process failed', {
+                'path': self._path,
+                'status': status,
+            })
+        return journal_gen
+
+    def export_data(self, journal_gen=None, fork=False):
+        if not self._path:
+            return
+        if journal_gen is not None:
+            self._write_snapshot(journal_gen)
+            return journal_gen
+        with self._snapshot_lock:
+            if fork:
+                return self._fork_snapshot()
+
+            start = time.time()
+            with self._lock_all():
+                journal_gen = self._journal_rotate() \
+                    if self._journal_file else 0
+                self._clear_dirty()
+                self._write_snapshot(journal_gen)
+        duration = time.time() - start
+        self._snapshot_stats = {
+            'mode': 'lock',
+            'duration': duration,
+            'pause': duration,
+        }
+        return journal_gen
+
+    def get_snapshot_stats(self):
+        return self._snapshot_stats.copy()
+
+    def _import_key(self, key, ttl, val):
+        shard = self._shard(key)
+        with shard.lock:
+            entry = self._set_entry(shard, key)
+            if self._indexes:
+                self._index_remove(key, entry.val)
+            entry.ttl = ttl
+            entry.val = val
+            self._resize(shard, entry, _entry_size(key, val))
+            if self._indexes:
+                self._index_add(key, val)
+
+            if ttl:
+                if ttl >= int(time.time() * 1000):
+                    self._schedule_expire(key, ttl)
+                else:
+                    self._get_entry(shard, key)
+
+    def _import_records(self, records):
+        # Imports into an empty cache skip the per key locks and sort the
+        # keys of each shard once, otherwise keys are set one at a time
+        commit_log = []
+        if any(shard.data for shard in self._shards):
+            for record in records:
+                if record[0] == RECORD_KEY:
+                    self._import_key(record[1], record[2], record[3])
+                elif record[0] == RECORD_REMOVE:
+                    self.remove(record[1])
+                else:
+                    commit_log.append(record[1])
+            return commit_log
+
+        shards = self._shards
+        shard_count = len(shards)
+        timers = {}
+        cur_time = time.time()
+        cur_time_ms = int(cur_time * 1000)
+        with self._lock_all():
+            for record in records:
+                if record[0] == RECORD_KEY and not (
+                        record[2] and record[2] < cur_time_ms):
+                    key, ttl, val = record[1:]
+                    shard = shards[hash(key) % shard_count]
+                    entry = shard.data.get(key)
+                    if entry is None:
+                        entry = CacheEntry()
+                        shard.data[key] = entry
+                    entry.ttl = ttl
+                    entry.val = val
+                    size = _entry_size(key, val)
+                    shard.used += size - entry.size
+                    entry.size = size
+                    if self._max_memory:
+                        entry.atime = cur_time
+                    if ttl:
+                        timers[key] = ttl
+                elif record[0] in (RECORD_KEY, RECORD_REMOVE):
+                    # Removed or already expired
+                    key = record[1]
+                    shard = shards[hash(key) % shard_count]
+                    entry = shard.data.pop(key, None)
+                    if entry is not None:
+                        shard.used -= entry.size
+                    timers.pop(key, None)
+                else:
+                    commit_log.append(record[1])
+
+            for shard in shards:
+                shard.keys.load(shard.data)
+                if self._journal_file:
+                    shard.dirty.update(shard.data)
+                if self._indexes:
+                    for key, entry in shard.data.iteritems():
+                        self._index_add(key, entry.val)
+
+        if timers:
+            self._schedule_expires(timers)
+        return commit_log
+
+    def _iter_json(self, import_data):
+        for key, key_type, key_ttl, key_val in import_data['data']:
+            if key_type == 'set':
+                key_val = set(key_val)
+            elif key_type == 'deque':
+                key_val = collections.deque(key_val)
+            yield RECORD_KEY, key, key_ttl, key_val
+
+    def _import_json(self):
+        # Compatibility with ver 1 json databases
+        with open(self._path, 'r') as db_file:
+            import_data = json.loads(db_file.read())
+
+        self._import_records(self._iter_json(import_data))
+
+        for trans in import_data.get('commit_log', []):
+            self._apply_trans(trans)
+
+        return import_data.get('journal_gen', 0)
+
+    def _import_snapshot(self, path):
+        reader = SnapshotReader(path)
+        try:
+            commit_log = self._import_records(reader)
+        finally:
+            reader.close()
+
+        for trans in commit_log:
+            self._apply_trans(trans)
+
+        return reader.journal_gen
+
+    def import_data(self, journal_gen=None):
+        snapshot_gen = 0
 
-    def import_data(self):
         if os.path.isfile(self._path):
-            with open(self._path, 'r') as db_file:
-                import_data = json.loads(db_file.read())
-                data = import_data['data']
-
-                for key_data in data:
-                    key = key_data[0]
-                    key_type = key_data[1]
-                    key_ttl = key_data[2]
-                    key_val = key_data[3]
-
-                    if key_type == 'set':
-                        key_val = set(key_val)
-                    elif key_type == 'deque':
-                        key_val = collections.deque(key_val)
-
-                    self._data[key]['ttl'] = key_ttl
-                    self._data[key]['val'] = key_val
-
-                if 'timers' in import_data:
-                    for key in import_data['timers']:
-                        if key not in self._data:
-                            continue
-                        ttl = self._data[key]['ttl']
-                        if not ttl:
-                            continue
-                        ttl -= int(time.time() * 1000)
-                        ttl = ttl / 1000.0
-                        if ttl >= 0:
-                            timer = threading.Timer(ttl + 0.01,
-                                self._check_ttl_timer, (key,))
-                            self._timers[key] = timer
-                            timer.start()
-                        else:
-                            self._check_ttl(key)
+            self._snapshot_size = os.path.getsize(self._path)
+            if is_snapshot(self._path):
+                snapshot_gen = self._import_snapshot(self._path)
+            else:
+                snapshot_gen = self._import_json()
+
+        # Each delta holds the changes from the journals before its gen
+        for gen in self._file_gens('delta'):
+            if gen <= snapshot_gen:
+                continue
+            if journal_gen is not None and gen > journal_gen:
+                break
+            self._import_snapshot(self._delta_path(gen))
+            self._delta_size += os.path.getsize(self._delta_path(gen))
+            snapshot_gen = gen
 
-                if 'commit_log' in import_data:
-                    for tran in import_data['commit_log']:
-                        self._apply_trans(tran)
+        for gen in self._file_gens('journal'):
+            if gen < snapshot_gen:
+                continue
+            if journal_gen is not None and gen >= journal_gen:
+                break
+            self._replay_journal(gen)
 
 class CacheTransaction:
     def __init__(self, cache):
@@ -450,7 +1919,14 @@ class CacheTransaction:
         self._trans = []
 
     def __getattr__(self, name):
-        if name in TRANSACTION_METHODS:
+        if name == 'expire':
+            # Store the absolute time so a replayed transaction expires
+            # at the original time
+            def serialize(key, ttl):
+                self._trans.append(('expire_at', (key,
+                    int(time.time() * 1000) + (ttl * 1000)), {}))
+            return serialize
+        elif name in TRANSACTION_METHODS:
             def serialize(*args, **kwargs):
                 self._trans.append((name, args, kwargs))
             return serialize
@@ -462,4 +1938,18 @@ class CacheTransaction:
         self._trans = []
         self._cache._apply_trans(trans)
 
+class CachePipeline(CacheTransaction):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+
+    def commit(self):
+        calls = self._trans
+        self._trans = []
+        if calls:
+            self._cache._apply_calls(calls)
+
 cache_db = Cache()
@@ -0,0 +1,263 @@
+from constants import *
+from exceptions import *
+import collections
+import itertools
+import struct
+import zlib
+import mmap
+import json
+import os
+
+_HEADER = struct.Struct('>4sIQ')
+_LENGTH = struct.Struct('>I')
+_KEY_HEAD = struct.Struct('>cqc')
+_BLOCK_HEAD = struct.Struct('>IIiB')
+
+BLOCK_ZLIB = 1
+
+RECORD_KEY = 'k'
+RECORD_COMMIT = 'c'
+RECORD_REMOVE = 'r'
+
+TYPE_NONE = 'n'
+TYPE_STR = 's'
+TYPE_SET = 'S'
+TYPE_DEQUE = 'L'
+TYPE_DICT = 'D'
+TYPE_JSON = 'j'
+
+def _decode_str(value):
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return value
+
+class SnapshotWriter:
+    def __init__(self, path, journal_gen=0, compress=True):
+        self.path = path
+        self._compress = compress
+        self._block = []
+        self._block_size = 0
+        self._file = open(path, 'wb')
+        self._file.write(_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VER,
+            journal_gen))
+
+    def _write_record(self, record):
+        # Records are buffered into blocks that are compressed and
+        # checksummed together, memory is bounded by the block size
+        self._block.append(_LENGTH.pack(len(record)))
+        self._block.append(record)
+        self._block_size += _LENGTH.size + len(record)
+        if self._block_size >= SNAPSHOT_BLOCK_SIZE:
+            self._write_block()
+
+    def _write_block(self):
+        if not self._block:
+            return
+        data = ''.join(self._block)
+        self._block = []
+        self._block_size = 0
+
+        flags = 0
+        if self._compress:
+            compressed = zlib.compress(data, SNAPSHOT_COMPRESS_LEVEL)
+            if len(compressed) < len(data):
+                flags = BLOCK_ZLIB
+                data_len = len(data)
+                data = compressed
+        if not flags:
+            data_len = len(data)
+
+        self._file.write(_BLOCK_HEAD.pack(len(data), data_len,
+            zlib.crc32(data), flags))
+        self._file.write(data)
+
+    def write_key(self, key, ttl, val):
+        if val is None:
+            val_type = TYPE_NONE
+            strs = [key]
+        elif isinstance(val, basestring):
+            val_type = TYPE_STR
+            strs = [key, val]
+        elif isinstance(val, set):
+            val_type = TYPE_SET
+            strs = [key]
+            strs.extend(val)
+        elif isinstance(val, collections.deque):
+            val_type = TYPE_DEQUE
+            strs = [key]
+            strs.extend(val)
+        elif isinstance(val, dict):
+            val_type = TYPE_DICT
+            strs = [key]
+            for item in val.iteritems():
+                strs.extend(item)
+        else:
+            val_type = TYPE_JSON
+            strs = None
+
+        # Strings are stored null separated so a record is decoded with
+        # a single split, anything else falls back to json
+        if strs is not None:
+            try:
+                payload = u'\x00'.join([_decode_str(x) for x in strs])
+                if payload.count(u'\x00') != len(strs) - 1:
+                    val_type = TYPE_JSON
+            except TypeError:
+                val_type = TYPE_JSON
+        if val_type == TYPE_JSON:
+            if isinstance(val, (set, collections.deque)):
+                payload = json.dumps([key, type(val).__name__, list(val)])
+            else:
+                payload = json.dumps([key, None, val])
+
+        self._write_record(_KEY_HEAD.pack(RECORD_KEY, ttl or 0, val_type) +
+            payload.encode('utf-8'))
+
+    def write_remove(self, key):
+        self._write_record(RECORD_REMOVE + _decode_str(key).encode('utf-8'))
+
+    def close(self):
+        self._write_block()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+class SnapshotReader:
+    def __init__(self, path):
+        self.path = path
+        self.journal_gen = 0
+        self._file = open(path, 'rb')
+        self._map = None
+
+        size = os.fstat(self._file.fileno()).st_size
+        if size < _HEADER.size:
+            self._file.close()
+            raise CacheSnapshotError('Cache snapshot is truncated', {
+                'path': path,
+            })
+        self._map = mmap.mmap(self._file.fileno(), 0,
+            access=mmap.ACCESS_READ)
+
+        magic, self.ver, self.journal_gen = _HEADER.unpack_from(
+            self._map, 0)
+        if magic != SNAPSHOT_MAGIC or self.ver not in (2, SNAPSHOT_VER):
+            self.close()
+            raise CacheSnapshotError('Unknown cache snapshot format', {
+                'path': path,
+            })
+
+    def _decode_json(self, payload):
+        key, type_name, val = json.loads(payload)
+        if type_name == 'set':
+            val = set(val)
+        elif type_name == 'deque':
+            val = collections.deque(val)
+        return key, val
+
+    def __iter__(self):
+        if self.ver == 2:
+            # Ver 2 snapshots store unblocked records
+            return self._iter_records(self._map, _HEADER.size,
+                len(self._map))
+        return self._iter_blocks()
+
+    def _iter_blocks(self):
+        snapshot_map = self._map
+        offset = _HEADER.size
+        end = len(snapshot_map)
+        while offset < end:
+            if offset + _BLOCK_HEAD.size > end:
+                raise CacheSnapshotError('Cache snapshot is truncated', {
+                    'path': self.path,
+                })
+            data_len, raw_len, crc, flags = _BLOCK_HEAD.unpack_from(
+                snapshot_map, offset)
+            offset += _BLOCK_HEAD.size
+            if offset + data_len > end:
+                raise CacheSnapshotError('Cache snapshot is truncated', {
+                    'path': self.path,
+                })
+            data = snapshot_map[offset:offset + data_len]
+            offset += data_len
+
+            if zlib.crc32(data) != crc:
+                raise CacheSnapshotError('Cache snapshot checksum failed', {
+                    'path': self.path,
+                    'offset': offset - data_len,
+                })
+            if flags & BLOCK_ZLIB:
+                data = zlib.decompress(data)
+            if len(data) != raw_len:
+                raise CacheSnapshotError('Cache snapshot block is corrupt', {
+                    'path': self.path,
+                    'offset': offset - data_len,
+                })
+
+            for record in self._iter_records(data, 0, raw_len):
+                yield record
+
+    def _iter_records(self, snapshot_map, offset, end):
+        unpack_length = _LENGTH.unpack_from
+        unpack_head = _KEY_HEAD.unpack_from
+        length_size = _LENGTH.size
+        head_size = _KEY_HEAD.size
+        islice = itertools.islice
+        izip = itertools.izip
+
+        while offset < end:
+            if offset + length_size > end:
+                raise CacheSnapshotError('Cache snapshot is truncated', {
+                    'path': self.path,
+                })
+            record_end = offset + length_size + \
+                unpack_length(snapshot_map, offset)[0]
+            offset += length_size
+            if record_end > end:
+                raise CacheSnapshotError('Cache snapshot is truncated', {
+                    'path': self.path,
+                })
+
+            record_type = snapshot_map[offset]
+            if record_type == RECORD_REMOVE:
+                yield RECORD_REMOVE, snapshot_map[
+                    offset + 1:record_end].decode('utf-8')
+                offset = record_end
+                continue
+            elif record_type != RECORD_KEY:
+                yield RECORD_COMMIT, json.loads(
+                    snapshot_map[offset + 1:record_end])
+                offset = record_end
+                continue
+
+            _, ttl, val_type = unpack_head(snapshot_map, offset)
+            payload = snapshot_map[offset + head_size:record_end].decode(
+                'utf-8')
+            offset = record_end
+
+            if val_type == TYPE_JSON:
+                key, val = self._decode_json(payload)
+                yield RECORD_KEY, key, ttl or None, val
+                continue
+
+            strs = payload.split(u'\x00')
+            if val_type == TYPE_DICT:
+                items = islice(strs, 1, None)
+                val = dict(izip(items, items))
+            elif val_type == TYPE_STR:
+                val = strs[1]
+            elif val_type == TYPE_SET:
+                val = set(islice(strs, 1, None))
+            elif val_type == TYPE_DEQUE:
+                val = collections.deque(islice(strs, 1, None))
+            else:
+                val = None
+            yield RECORD_KEY, strs[0], ttl or None, val
+
+    def close(self):
+        if self._map:
+            self._map.close()
+        self._file.close()
+
+def is_snapshot(path):
+    with open(path, 'rb') as snapshot_file:
+        return snapshot_file.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
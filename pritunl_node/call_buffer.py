@@ -1,22 +1,57 @@
 from constants import *
+import tornado.ioloop
 import collections
+import time
 import uuid
 
 class CallBuffer():
     def __init__(self):
         self.waiter = None
         self.queue = collections.deque(maxlen=CALL_QUEUE_MAX)
+        self.event_queue = collections.deque(maxlen=CALL_EVENT_QUEUE_MAX)
+        self.output_queue = collections.deque(maxlen=CALL_OUTPUT_QUEUE_MAX)
         self.call_waiters = {}
+        self._output_tokens = CALL_OUTPUT_BURST
+        self._output_time = time.time()
+        self._output_timeout = None
+
+    def _get_output_calls(self):
+        # Low priority calls are queued separately and sent at a limited
+        # rate so output can not push auth calls out of the queue
+        cur_time = time.time()
+        self._output_tokens = min(CALL_OUTPUT_BURST, self._output_tokens +
+            (cur_time - self._output_time) * CALL_OUTPUT_RATE)
+        self._output_time = cur_time
+
+        calls = []
+        while self.output_queue and self._output_tokens >= 1:
+            calls.append(self.output_queue.popleft())
+            self._output_tokens -= 1
+
+        if self.output_queue and not self._output_timeout:
+            self._output_timeout = tornado.ioloop.IOLoop.instance(
+                ).add_timeout(cur_time + (1 - self._output_tokens) /
+                    CALL_OUTPUT_RATE, self._on_output_timeout)
+        return calls
+
+    def _on_output_timeout(self):
+        self._output_timeout = None
+        if self.waiter:
+            calls = self._get_output_calls()
+            if calls:
+                self.waiter(calls)
 
     def wait_for_calls(self, callback):
         self.stop_waiter()
         self.waiter = callback
         calls = []
-        while True:
-            try:
-                calls.append(self.queue.popleft())
-            except IndexError:
-                break
+        for queue in (self.queue, self.event_queue):
+            while True:
+                try:
+                    calls.append(queue.popleft())
+                except IndexError:
+                    break
+        calls.extend(self._get_output_calls())
         if calls:
             callback(calls)
             return
@@ -34,7 +69,8 @@ class CallBuffer():
         if callback:
             callback(response)
 
-    def create_call(self, command, args, callback=None):
+    def create_call(self, command, args, callback=None, low_priority=False,
+            event=False):
         call_id = uuid.uuid4().hex
         call = {
             'id': call_id,
@@ -45,8 +81,18 @@ class CallBuffer():
         if callback:
             self.call_waiters[call_id] = callback
 
-        if self.waiter:
+        if low_priority:
+            self.output_queue.append(call)
+            if self.waiter:
+                calls = self._get_output_calls()
+                if calls:
+                    self.waiter(calls)
+        elif self.waiter:
             self.waiter([call])
+        elif event:
+            # Events are not rate limited but are queued separately so
+            # they can not push auth calls out of the queue
+            self.event_queue.append(call)
         else:
             self.queue.append(call)
 
@@ -160,16 +160,17 @@ class Config:
                 raise ValueError('Object ID is required for caching')
             if cache_db.get(self.get_cache_key('cached')) == 't':
                 if merge:
-                    for name, value in cache_db.dict_get_all(
-                            self.get_cache_key()).iteritems():
+                    for name, value in cache_db.dict_iter(
+                            self.get_cache_key()):
                         if name in self.__dict__:
                             continue
                         self.__dict__[name] = value
                 else:
-                    self.__dict__.update(cache_db.dict_get_all(
+                    self.__dict__.update(cache_db.dict_iter(
                         self.get_cache_key()))
                 return
 
+        cache_values = {}
         try:
             with open(self._conf_path) as config:
                 for line in config:
@@ -193,8 +194,7 @@ class Config:
                             continue
                         self.__dict__[name] = value
                         if self.cached:
-                            cache_db.dict_set(self.get_cache_key(),
-                                name, value)
+                            cache_values[name] = value
                     except ValueError:
                         logger.warning('Ignoring invalid line. %r' % {
                             'line': line,
@@ -204,6 +204,7 @@ class Config:
                 raise
 
         if self.cached:
+            cache_db.dict_set_many(self.get_cache_key(), cache_values)
             cache_db.set(self.get_cache_key('cached'), 't')
 
     def commit(self):
@@ -211,6 +212,7 @@ class Config:
         if not self._loaded:
             self.load(True)
 
+        cache_values = {}
         try:
             temp_conf_path = self._conf_path + CONF_TEMP_EXT
             with open(temp_conf_path, 'w') as config:
@@ -224,9 +226,11 @@ class Config:
                     if value is None:
                         continue
                     if self.cached:
-                        cache_db.dict_set(self.get_cache_key(), name, value)
+                        cache_values[name] = value
                     config.write(self._encode_line(name, value))
             os.rename(temp_conf_path, self._conf_path)
+            if self.cached:
+                cache_db.dict_set_many(self.get_cache_key(), cache_values)
         except:
             try:
                 os.remove(temp_conf_path)
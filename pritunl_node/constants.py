@@ -4,16 +4,59 @@ SAVED = 'saved'
 UNSAVED = 'unsaved'
 
 CALL_QUEUE_MAX = 256
+CALL_EVENT_QUEUE_MAX = 64
+CALL_OUTPUT_QUEUE_MAX = 64
+CALL_OUTPUT_RATE = 10
+CALL_OUTPUT_BURST = 20
+OUTPUT_READ_SIZE = 16384
+OUTPUT_BATCH_SIZE = 16384
+OUTPUT_BATCH_TIME = 0.1
+SUPERVISOR_REAP_INTERVAL = 0.1
+OUTPUT_LINES = 'output_lines'
+OVPN_EVENT_PEER_CONNECTED = 'peer_connected'
+OVPN_EVENT_TLS_ERROR = 'tls_error'
+OVPN_EVENT_AUTH_FAILED = 'auth_failed'
+OVPN_EVENT_ROUTE_ADDED = 'route_added'
+OVPN_EVENT_RESTART = 'restart'
 SERVER_PORT = 9800
 SUB_RESPONSE_TIMEOUT = 15
+SUB_QUEUE_MAX = 64
+SUB_OVERFLOW_DROP_OLDEST = 'drop_oldest'
+SUB_OVERFLOW_DROP_NEWEST = 'drop_newest'
+STATUS_CHECK_INTERVAL = 1
+CACHE_KEYSPACE_CHANNEL = '__keyspace__:%s'
+CACHE_KEYPREFIX_CHANNEL = '__keyprefix__:%s'
 THREAD_EVENT_TIMEOUT = 15
 CALL_RESPONSE_TIMEOUT = 5
+CACHE_SHARDS = 16
+CACHE_KEY_OVERHEAD = 64
+CACHE_ELEMENT_OVERHEAD = 16
+CACHE_EVICT_SAMPLES = 5
+CACHE_SCAN_COUNT = 10
+CACHE_KEYS_CHUNK = 512
+CACHE_LOCK_WAIT_BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+CACHE_LOCK_CONTENTION_MAX = 256
+CACHE_EVICT_LRU = 'lru'
+CACHE_EVICT_LFU = 'lfu'
+CACHE_EVICT_VOLATILE_TTL = 'volatile_ttl'
+CACHE_EVICT_NONE = 'noeviction'
+JOURNAL_FSYNC_NEVER = 'never'
+JOURNAL_FSYNC_EVERYSEC = 'everysec'
+JOURNAL_FSYNC_ALWAYS = 'always'
+JOURNAL_SYNC_INTERVAL = 1
+JOURNAL_REWRITE_MIN_SIZE = 4194304
+SNAPSHOT_MAX_STALENESS = 30
+SNAPSHOT_MAGIC = 'PNDB'
+SNAPSHOT_VER = 3
+SNAPSHOT_BLOCK_SIZE = 262144
+SNAPSHOT_COMPRESS_LEVEL = 1
 DEFAULT_CONF_PATH = '/etc/pritunl-node.conf'
 DEFAULT_DATA_PATH = '/var/lib/pritunl-node'
 SERVER_CERT_NAME = 'server.crt'
 SERVER_KEY_NAME = 'server.key'
 OVPN_CONF_NAME = 'openvpn.conf'
 OVPN_STATUS_NAME = 'status'
+OVPN_MANAGEMENT_NAME = 'management.sock'
 IFC_POOL_NAME = 'ifc_pool'
 AUTH_LOG_NAME = 'auth.log'
 CONF_TEMP_EXT = '.tmp'
@@ -21,7 +64,8 @@ TLS_VERIFY_NAME = 'tls_verify.py'
 USER_PASS_VERIFY_NAME = 'user_pass_verify.py'
 CLIENT_CONNECT_NAME = 'client_connect.py'
 CLIENT_DISCONNECT_NAME = 'client_disconnect.py'
-IP_REGEX = r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}'
+ROUTE_PATH = '/proc/net/route'
+ROUTE6_PATH = '/proc/net/ipv6_route'
 
 # Script will run in python 2 and 3
 TLS_VERIFY_SCRIPT = """#!/usr/bin/env python
@@ -35,3 +35,22 @@ class IptablesError(ServerError):
 
 class InvalidStaticFile(ServerError):
     pass
+
+
+class CacheError(BaseError):
+    pass
+
+class CacheSnapshotError(CacheError):
+    pass
+
+class CacheMemoryError(CacheError):
+    pass
+
+class CacheIndexError(CacheError):
+    pass
+
+class CacheLockError(CacheError):
+    pass
+
+class CacheDeadlockError(CacheLockError):
+    pass
@@ -11,6 +11,9 @@ import time
 logger = logging.getLogger(APP_NAME)
 
 class ServerHandler(AuthHandler):
+    server = None
+
+    @tornado.web.asynchronous
     def post(self, server_id):
         data = tornado.escape.json_decode(self.request.body)
         interface = data['interface']
@@ -19,7 +22,7 @@ class ServerHandler(AuthHandler):
         ovpn_conf = data['ovpn_conf']
         server_ver = data.get('server_ver', 0)
 
-        server = Server(
+        self.server = Server(
             id=server_id,
             interface=interface,
             network=network,
@@ -27,22 +30,28 @@ class ServerHandler(AuthHandler):
             ovpn_conf=ovpn_conf,
             server_ver=server_ver,
         )
-        server.initialize()
-        server.start()
-
-        self.write({
-            'id': server.id,
-        })
+        self.server.initialize(self.on_initialize)
 
+    @tornado.web.asynchronous
     def delete(self, server_id):
-        server = Server.get_server(id=server_id)
-        if not server:
+        self.server = Server.get_server(id=server_id)
+        if not self.server:
             self.send_error(404)
             return
-        server.remove()
+        self.server.remove(self.on_response)
 
-        self.write({
-            'id': server_id,
+    def on_initialize(self, error):
+        if error:
+            raise error
+        self.server.start(self.on_response)
+
+    def on_response(self, error):
+        if error:
+            raise error
+        if self.request.connection.stream.closed():
+            return
+        self.finish({
+            'id': self.server.id,
         })
 app_server.app.add_handlers('.*', [(r'/server/([a-z0-9]+)', ServerHandler)])
 
@@ -236,7 +245,12 @@ class ServerComHandler(WebSocketAuthHandler):
     def on_close(self):
         if self.call_buffer:
             self.call_buffer.cancel_waiter()
-        if self.server:
-            self.server.remove()
+        # The server may already have been replaced by a new initialize
+        if self.server and Server.get_server(self.server.id) is self.server:
+            self.server.remove(self.on_remove)
+
+    def on_remove(self, error):
+        if error:
+            raise error
 app_server.app.add_handlers('.*', [(r'/server/([a-z0-9]+)/com',
     ServerComHandler)])
@@ -0,0 +1,216 @@
+from constants import *
+import tornado.iostream
+import collections
+import logging
+import socket
+
+logger = logging.getLogger(APP_NAME)
+
+_STATUS_COLUMNS = {
+    'Common Name': 'client_id',
+    'Real Address': 'real_address',
+    'Virtual Address': 'virt_address',
+    'Bytes Received': 'bytes_received',
+    'Bytes Sent': 'bytes_sent',
+    'Connected Since (time_t)': 'connected_since',
+    'Client ID': 'cid',
+}
+# Column layout of openvpn 2.3 when no client list header is sent
+_STATUS_DEFAULT = ('client_id', 'real_address', 'virt_address',
+    'bytes_received', 'bytes_sent', None, 'connected_since')
+
+class ManagementClient:
+    # Client for the openvpn management interface on a unix socket, must
+    # only be used from the ioloop. The clients table is kept live from
+    # >CLIENT: notifications and replaced on each status query.
+    def __init__(self, path, callback=None):
+        self.path = path
+        self.clients = {}
+        self.connected = False
+        self.connecting = False
+        self._callback = callback
+        self._stream = None
+        self._waiters = collections.deque()
+        self._response = None
+        self._cids = {}
+        self._event = None
+        self._event_env = None
+
+    def connect(self):
+        if self._stream:
+            return
+        self.connecting = True
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._stream = tornado.iostream.IOStream(sock)
+        self._stream.set_close_callback(self._on_close)
+        self._stream.connect(self.path, self._on_connect)
+
+    def close(self):
+        if self._stream:
+            self._stream.close()
+
+    def _on_connect(self):
+        logger.debug('Connected to ovpn management. %r' % {
+            'path': self.path,
+        })
+        self.connecting = False
+        self.connected = True
+        self._read_line()
+
+    def _on_close(self):
+        if self.connected:
+            logger.debug('Disconnected from ovpn management. %r' % {
+                'path': self.path,
+            })
+        self.connected = False
+        self.connecting = False
+        self._stream = None
+        self._response = None
+        self._event = None
+        self._event_env = None
+        waiters = self._waiters
+        self._waiters = collections.deque()
+        for callback in waiters:
+            if callback:
+                callback(None)
+
+    def _read_line(self):
+        if self._stream and not self._stream.closed():
+            self._stream.read_until('\n', self._on_line)
+
+    def _on_line(self, line):
+        line = line.rstrip('\r\n')
+        try:
+            # Notifications start with > and may arrive in between the
+            # lines of a command response
+            if line.startswith('>'):
+                self._on_notification(line[1:])
+            else:
+                self._on_response(line)
+        except:
+            logger.exception('Failed to parse ovpn management line. %r' % {
+                'path': self.path,
+                'line': line,
+            })
+        self._read_line()
+
+    def _on_notification(self, line):
+        if not line.startswith('CLIENT:'):
+            return
+        event, _, args = line[7:].partition(',')
+
+        if event == 'ENV':
+            if self._event_env is None:
+                return
+            if args == 'END':
+                self._on_client_event(self._event, self._event_env)
+                self._event = None
+                self._event_env = None
+                return
+            name, _, value = args.partition('=')
+            self._event_env[name] = value
+            return
+
+        args = args.split(',')
+        if event in ('ESTABLISHED', 'DISCONNECT'):
+            self._event = (event, args[0])
+        else:
+            self._event = None
+        self._event_env = {}
+
+    def _on_client_event(self, event, env):
+        if not event:
+            return
+        event, cid = event
+
+        if event == 'ESTABLISHED':
+            client_id = env.get('common_name')
+            if not client_id:
+                return
+            self._cids[cid] = client_id
+            real_address = env.get('trusted_ip', '')
+            if env.get('trusted_port'):
+                real_address += ':%s' % env['trusted_port']
+            # Tables handed to callbacks are not changed, events replace
+            # the table instead
+            self.clients = dict(self.clients)
+            self.clients[client_id] = {
+                'real_address': real_address,
+                'virt_address': env.get('ifconfig_pool_remote_ip', ''),
+                'bytes_received': 0,
+                'bytes_sent': 0,
+                'connected_since': int(env.get('time_unix') or 0),
+            }
+        else:
+            client_id = self._cids.pop(cid, None) or env.get('common_name')
+            if client_id not in self.clients:
+                return
+            self.clients = dict(self.clients)
+            del self.clients[client_id]
+
+        if self._callback:
+            self._callback(self.clients)
+
+    def _on_response(self, line):
+        if not self._waiters:
+            return
+
+        if self._response is None:
+            if line.startswith('ERROR:'):
+                logger.warning('Ovpn management command failed. %r' % {
+                    'path': self.path,
+                    'response': line,
+                })
+                callback = self._waiters.popleft()
+                if callback:
+                    callback(None)
+                return
+            self._response = []
+
+        if line != 'END':
+            self._response.append(line)
+            return
+        response = self._response
+        self._response = None
+        self._on_status(response, self._waiters.popleft())
+
+    def _on_status(self, lines, callback):
+        columns = _STATUS_DEFAULT
+        clients = {}
+        cids = {}
+
+        for line in lines:
+            line_split = line.split('\t')
+            if line_split[0] == 'HEADER':
+                if len(line_split) > 1 and line_split[1] == 'CLIENT_LIST':
+                    columns = [_STATUS_COLUMNS.get(x)
+                        for x in line_split[2:]]
+                continue
+            elif line_split[0] != 'CLIENT_LIST':
+                continue
+
+            client = dict(zip(columns, line_split[1:]))
+            client.pop(None, None)
+            client_id = client.pop('client_id')
+            cid = client.pop('cid', None)
+            if cid is not None:
+                cids[cid] = client_id
+            for name in ('bytes_received', 'bytes_sent', 'connected_since'):
+                client[name] = int(client.get(name) or 0)
+            clients[client_id] = client
+
+        self.clients = clients
+        self._cids = cids
+
+        if callback:
+            callback(clients)
+        if self._callback:
+            self._callback(clients)
+
+    def query_status(self, callback=None):
+        if not self.connected:
+            if callback:
+                callback(None)
+            return
+        self._waiters.append(callback)
+        self._stream.write('status 3\n')
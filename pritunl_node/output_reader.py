@@ -0,0 +1,100 @@
+from constants import *
+import tornado.ioloop
+import functools
+import logging
+import fcntl
+import errno
+import time
+import os
+
+logger = logging.getLogger(APP_NAME)
+
+class OutputPipe:
+    def __init__(self, server, pipe, callback):
+        self.server = server
+        self.pipe = pipe
+        self.callback = callback
+        self.partial = ''
+        self.lines = []
+        self.size = 0
+        self.timeout = None
+
+class OutputReader:
+    def __init__(self):
+        self._pipes = {}
+
+    def add(self, server, pipe, callback=None):
+        # Pipes are read on the ioloop and lines are pushed in batches
+        # bounded by size and time, the callback is run on EOF
+        tornado.ioloop.IOLoop.instance().add_callback(
+            functools.partial(self._add, server, pipe, callback))
+
+    def _add(self, server, pipe, callback):
+        io_loop = tornado.ioloop.IOLoop.instance()
+        fd = pipe.fileno()
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self._pipes[fd] = OutputPipe(server, pipe, callback)
+        io_loop.add_handler(fd, self._on_read, io_loop.READ)
+
+    def _on_read(self, fd, events):
+        output_pipe = self._pipes.get(fd)
+        if not output_pipe:
+            return
+
+        try:
+            data = os.read(fd, OUTPUT_READ_SIZE)
+        except OSError as error:
+            if error.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            logger.exception('Failed to read server output. %r' % {
+                'server_id': output_pipe.server.id,
+            })
+            data = ''
+
+        if not data:
+            tornado.ioloop.IOLoop.instance().remove_handler(fd)
+            del self._pipes[fd]
+            output_pipe.pipe.close()
+            if output_pipe.partial:
+                output_pipe.lines.append(output_pipe.partial)
+                output_pipe.partial = ''
+            self._flush(output_pipe)
+            if output_pipe.callback:
+                output_pipe.callback()
+            return
+
+        lines = (output_pipe.partial + data).split('\n')
+        output_pipe.partial = lines.pop()
+        if len(output_pipe.partial) >= OUTPUT_BATCH_SIZE:
+            lines.append(output_pipe.partial)
+            output_pipe.partial = ''
+        output_pipe.lines.extend(lines)
+        output_pipe.size += len(data)
+
+        if output_pipe.size >= OUTPUT_BATCH_SIZE:
+            self._flush(output_pipe)
+        elif output_pipe.lines and not output_pipe.timeout:
+            output_pipe.timeout = tornado.ioloop.IOLoop.instance(
+                ).add_timeout(time.time() + OUTPUT_BATCH_TIME,
+                    functools.partial(self._flush, output_pipe))
+
+    def _flush(self, output_pipe):
+        if output_pipe.timeout:
+            tornado.ioloop.IOLoop.instance().remove_timeout(
+                output_pipe.timeout)
+            output_pipe.timeout = None
+        if not output_pipe.lines:
+            return
+        lines = output_pipe.lines
+        output_pipe.lines = []
+        output_pipe.size = len(output_pipe.partial)
+
+        try:
+            output_pipe.server.push_lines(lines)
+        except:
+            logger.exception('Failed to push server output. %r' % {
+                'server_id': output_pipe.server.id,
+            })
+
+output_reader = OutputReader()
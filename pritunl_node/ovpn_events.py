@@ -0,0 +1,43 @@
+from constants import *
+import re
+
+# Each pattern is only searched when its keyword is in the line, a peer
+# group is split into the client name and address
+_PATTERNS = (
+    ('Peer Connection Initiated', OVPN_EVENT_PEER_CONNECTED, re.compile(
+        r'(?P<peer>\S+) \[(?P<client>[^\]]*)\] Peer Connection Initiated ' +
+        r'with (?:\[AF_INET6?\])?(?P<address>\S+)')),
+    ('TLS Error', OVPN_EVENT_TLS_ERROR, re.compile(
+        r'(?P<peer>\S+) TLS Error: (?P<message>.+)')),
+    ('TLS Auth Error', OVPN_EVENT_AUTH_FAILED, re.compile(
+        r'(?P<peer>\S+) TLS Auth Error: (?P<message>.+)')),
+    ('VERIFY', OVPN_EVENT_AUTH_FAILED, re.compile(
+        r'(?P<peer>\S+) VERIFY (?:SCRIPT )?ERROR: (?P<message>.+)')),
+    ('MULTI', OVPN_EVENT_ROUTE_ADDED, re.compile(
+        r'MULTI: (?:Learn: |internal route )(?P<route>\S+) -> ' +
+        r'(?P<peer>\S+)')),
+    ('restarting', OVPN_EVENT_RESTART, re.compile(
+        r'(?P<signal>SIG\w+)\[(?P<mode>\w+),(?P<message>[^\]]*)\] ' +
+        r'received, (?P<scope>client-instance|process) restarting')),
+)
+
+def parse_line(line):
+    for keyword, event_type, pattern in _PATTERNS:
+        if keyword not in line:
+            continue
+        match = pattern.search(line)
+        if not match:
+            continue
+
+        event = {'type': event_type}
+        groups = match.groupdict()
+        peer = groups.pop('peer', None)
+        for name, value in groups.iteritems():
+            if value:
+                event[name] = value
+        if peer:
+            client, _, address = peer.rpartition('/')
+            if client:
+                event.setdefault('client', client)
+            event.setdefault('address', address)
+        return event
@@ -0,0 +1,110 @@
+from constants import *
+import socket
+import struct
+
+RTF_UP = 0x1
+RTF_REJECT = 0x200
+
+class RouteTrie:
+    # Binary trie on the address bits, nodes are [zero, one, route] and a
+    # lookup returns the last route passed which is the longest prefix
+    def __init__(self, bits):
+        self.bits = bits
+        self._root = [None, None, None]
+
+    def add(self, network, prefix_len, interface, metric):
+        node = self._root
+        shift = self.bits - 1
+        for i in xrange(prefix_len):
+            bit = (network >> (shift - i)) & 1
+            child = node[bit]
+            if child is None:
+                child = node[bit] = [None, None, None]
+            node = child
+        if node[2] is None or metric < node[2][1]:
+            node[2] = (interface, metric)
+
+    def lookup(self, address, prefix_len=None):
+        if prefix_len is None:
+            prefix_len = self.bits
+        node = self._root
+        route = node[2]
+        shift = self.bits - 1
+        for i in xrange(prefix_len):
+            node = node[(address >> (shift - i)) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                route = node[2]
+        if route:
+            return route[0]
+
+class RouteTable:
+    def __init__(self, path=ROUTE_PATH, path6=ROUTE6_PATH):
+        self.path = path
+        self.path6 = path6
+        self._tables = {}
+
+    def _parse_routes(self, data):
+        routes = []
+        for line in data.splitlines()[1:]:
+            line_split = line.split()
+            if len(line_split) < 8:
+                continue
+            flags = int(line_split[3], 16)
+            if not flags & RTF_UP or flags & RTF_REJECT:
+                continue
+            # Addresses are written in host byte order
+            network = struct.unpack('>I', struct.pack('=I',
+                int(line_split[1], 16)))[0]
+            mask = int(line_split[7], 16)
+            routes.append((network, bin(mask).count('1'), line_split[0],
+                int(line_split[6])))
+        return routes
+
+    def _parse_routes6(self, data):
+        routes = []
+        for line in data.splitlines():
+            line_split = line.split()
+            if len(line_split) < 10:
+                continue
+            flags = int(line_split[8], 16)
+            if not flags & RTF_UP or flags & RTF_REJECT or \
+                    line_split[9] == 'lo':
+                continue
+            routes.append((int(line_split[0], 16), int(line_split[1], 16),
+                line_split[9], int(line_split[5], 16)))
+        return routes
+
+    def _get_trie(self, path, parse, bits):
+        with open(path, 'r') as route_file:
+            routes = parse(route_file.read())
+
+        # Reading and splitting the table is cheap, the trie is only
+        # rebuilt when the routes have changed
+        table = self._tables.get(path)
+        if table and table[0] == routes:
+            return table[1]
+
+        trie = RouteTrie(bits)
+        for route in routes:
+            trie.add(*route)
+        self._tables[path] = (routes, trie)
+        return trie
+
+    def get_interface(self, network):
+        address, _, prefix_len = network.partition('/')
+        if ':' in address:
+            trie = self._get_trie(self.path6, self._parse_routes6, 128)
+            address = int(socket.inet_pton(
+                socket.AF_INET6, address).encode('hex'), 16)
+        else:
+            trie = self._get_trie(self.path, self._parse_routes, 32)
+            address = struct.unpack('>I', socket.inet_aton(address))[0]
+
+        # Only routes that cover the whole network are matched
+        if prefix_len:
+            return trie.lookup(address, int(prefix_len))
+        return trie.lookup(address)
+
+route_table = RouteTable()
@@ -2,24 +2,40 @@ from constants import *
 from exceptions import *
 from call_buffer import CallBuffer
 from cache import cache_db
+from status_watcher import status_watcher
+from route_table import route_table
+from supervisor import supervisor
 from pritunl_node import app_server
+import tornado.ioloop
 import subprocess
+import collections
+import time
 import os
-import signal
-import threading
 import traceback
+import functools
 import logging
-import time
+import signal
 import utils
-import re
+import ovpn_events
 
 logger = logging.getLogger(APP_NAME)
-_call_buffers = {}
+_servers = {}
+
+class Server(object):
+    __slots__ = ('id', 'interface', 'network', 'local_networks', 'ovpn_conf',
+        'server_ver', 'path', 'ovpn_conf_path', 'tls_verify_path',
+        'user_pass_verify_path', 'client_connect_path',
+        'client_disconnect_path', 'ovpn_status_path', 'ovpn_management_path',
+        'auth_log_path', 'status', 'call_buffer', 'event_counts', 'clients',
+        '_cur_client_count')
 
-class Server:
     def __init__(self, id=None, interface=None, network=None,
             local_networks=None, ovpn_conf=None, server_ver=None):
         self._cur_client_count = 0
+        self.status = False
+        self.call_buffer = None
+        self.event_counts = None
+        self.clients = {}
 
         self.id = id
         self.interface = interface
@@ -37,37 +53,37 @@ class Server:
         self.client_disconnect_path = os.path.join(self.path,
             CLIENT_DISCONNECT_NAME)
         self.ovpn_status_path = os.path.join(self.path, OVPN_STATUS_NAME)
+        self.ovpn_management_path = os.path.join(self.path,
+            OVPN_MANAGEMENT_NAME)
         self.auth_log_path = os.path.join(app_server.data_path, AUTH_LOG_NAME)
 
-    def __setattr__(self, name, value):
-        if name == 'status':
-            if value:
-                cache_db.dict_set(self.get_cache_key(), name, 't')
-            else:
-                cache_db.dict_set(self.get_cache_key(), name, 'f')
-        else:
-            self.__dict__[name] = value
-
-    def __getattr__(self, name):
-        if name == 'status':
-            if cache_db.dict_get(self.get_cache_key(), name) == 't':
-                return True
-            return False
-        elif name == 'call_buffer':
-            return _call_buffers.get(self.id)
-        elif name not in self.__dict__:
-            raise AttributeError('Server instance has no attribute %r' % name)
-        return self.__dict__[name]
-
-    def initialize(self):
+    def initialize(self, callback=None):
         logger.debug('Initialize server. %r' % {
             'server_id': self.id,
         })
-        if self.status:
-            self.remove()
-        _call_buffers[self.id] = CallBuffer()
+        # Replaces the registered server with the same id
+        server = _servers.get(self.id)
+        if server:
+            if callback:
+                server.remove(functools.partial(self._on_initialize_remove,
+                    callback))
+                return
+            server.remove()
+        self._initialize()
+        if callback:
+            callback(None)
+
+    def _initialize(self):
+        self.call_buffer = CallBuffer()
+        self.event_counts = collections.Counter()
         if not os.path.isdir(self.path):
             os.makedirs(self.path)
+        _servers[self.id] = self
+
+    def _on_initialize_remove(self, callback, error):
+        if not error:
+            self._initialize()
+        callback(error)
 
     def get_cache_key(self, suffix=None):
         key = 'server-%s' % self.id
@@ -75,19 +91,36 @@ class Server:
             key += '-%s' % suffix
         return key
 
-    def remove(self):
+    def remove(self, callback=None):
         logger.debug('Removing server. %r' % {
             'server_id': self.id,
         })
 
         if self.status:
+            if callback:
+                self.force_stop(functools.partial(self._on_remove_stop,
+                    callback))
+                return
             self.force_stop()
+        self._remove()
+        if callback:
+            callback(None)
 
+    def _remove(self):
         utils.rmtree(self.path)
-        call_buffer = _call_buffers.pop(self.id, None)
+        if _servers.get(self.id) is self:
+            del _servers[self.id]
+        call_buffer = self.call_buffer
+        self.call_buffer = None
+        self.event_counts = None
         if call_buffer:
             call_buffer.stop_waiter()
 
+    def _on_remove_stop(self, callback, error):
+        if not error:
+            self._remove()
+        callback(error)
+
     def _parse_network(self, network):
         network_split = network.split('/')
         address = network_split[0]
@@ -136,6 +169,8 @@ class Server:
                 self.client_disconnect_path,
                 self.ovpn_status_path,
             )
+        server_conf = server_conf.rstrip('\n') + \
+            '\nmanagement %s unix\n' % self.ovpn_management_path
 
         with open(self.ovpn_conf_path, 'w') as ovpn_conf:
             os.chmod(self.ovpn_conf_path, 0600)
@@ -151,188 +186,262 @@ class Server:
             })
             raise
 
+    def _get_iptables_chains(self):
+        # Chain names are limited to 28 characters
+        chain_id = self.id[:16]
+        return (
+            ('filter', 'INPUT', 'PNI-%s' % chain_id),
+            ('filter', 'FORWARD', 'PNF-%s' % chain_id),
+            ('nat', 'POSTROUTING', 'PNP-%s' % chain_id),
+        )
+
     def _generate_iptables_rules(self):
+        input_chain, forward_chain, postrouting_chain = [
+            x[2] for x in self._get_iptables_chains()]
         rules = []
 
         try:
-            routes_output = subprocess.check_output(['route', '-n'],
-                stderr=subprocess.PIPE)
-        except subprocess.CalledProcessError:
+            default_interface = route_table.get_interface('0.0.0.0/0')
+        except (IOError, ValueError):
             logger.exception('Failed to get IP routes. %r' % {
                 'server_id': self.id,
             })
             raise
 
-        routes = {}
-        for line in routes_output.splitlines():
-            line_split = line.split()
-            if len(line_split) < 8 or not re.match(IP_REGEX, line_split[0]):
-                continue
-            routes[line_split[0]] = line_split[7]
-
-        if '0.0.0.0' not in routes:
+        if not default_interface:
             raise IptablesError('Failed to find default network interface', {
                 'server_id': self.id,
             })
-        default_interface = routes['0.0.0.0']
 
-        rules.append(['INPUT', '-i', self.interface, '-j', 'ACCEPT'])
-        rules.append(['FORWARD', '-i', self.interface, '-j', 'ACCEPT'])
+        rules.append(('filter', [input_chain, '-i', self.interface,
+            '-j', 'ACCEPT']))
+        rules.append(('filter', [forward_chain, '-i', self.interface,
+            '-j', 'ACCEPT']))
 
         interfaces = set()
         for network_address in self.local_networks or ['0.0.0.0/0']:
-            args = ['POSTROUTING', '-t', 'nat']
+            args = [postrouting_chain]
             network = self._parse_network(network_address)[0]
+            interface = route_table.get_interface(network_address)
 
-            if network not in routes:
+            if not interface:
                 logger.debug('Failed to find interface for local network ' + \
                         'route, using default route. %r' % {
                     'server_id': self.id,
                 })
                 interface = default_interface
-            else:
-                interface = routes[network]
             interfaces.add(interface)
 
             if network != '0.0.0.0':
                 args += ['-d', network_address]
 
             args += ['-s', self.network, '-o', interface, '-j', 'MASQUERADE']
-            rules.append(args)
+            rules.append(('nat', args))
 
         for interface in interfaces:
-            rules.append(['FORWARD', '-i', interface, '-o', self.interface,
-                '-m', 'state', '--state', 'ESTABLISHED,RELATED',
-                '-j', 'ACCEPT'])
-            rules.append(['FORWARD', '-i', self.interface, '-o', interface,
-                '-m', 'state', '--state', 'ESTABLISHED,RELATED',
-                '-j', 'ACCEPT'])
+            rules.append(('filter', [forward_chain, '-i', interface,
+                '-o', self.interface, '-m', 'state',
+                '--state', 'ESTABLISHED,RELATED', '-j', 'ACCEPT']))
+            rules.append(('filter', [forward_chain, '-i', self.interface,
+                '-o', interface, '-m', 'state',
+                '--state', 'ESTABLISHED,RELATED', '-j', 'ACCEPT']))
 
         return rules
 
-    def _exists_iptables_rules(self, rule):
-        logger.debug('Checking for iptables rule. %r' % {
-            'server_id': self.id,
-            'rule': rule,
-        })
+    def _restore_iptables(self, lines):
+        # Tables are committed atomically, --noflush leaves rules that
+        # are not in the server chains untouched
+        process = subprocess.Popen(['iptables-restore', '--noflush'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        _, error = process.communicate('\n'.join(lines) + '\n')
+        return process.returncode, error
+
+    def _get_iptables_state(self):
+        # Returns the server chains that exist and the number of jumps to
+        # each, a chain left by an unclean exit may be jumped to again
         try:
-            subprocess.check_call(['iptables', '-C'] + rule,
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        except subprocess.CalledProcessError:
-            return False
-        return True
+            output = subprocess.check_output(['iptables-save'],
+                stderr=subprocess.PIPE)
+        except (OSError, subprocess.CalledProcessError):
+            logger.exception('Failed to get iptables rules. %r' % {
+                'server_id': self.id,
+            })
+            raise
+
+        chains = {chain: (table, hook) for table, hook, chain in
+            self._get_iptables_chains()}
+        existing = set()
+        jumps = collections.Counter()
+        table = None
+        for line in output.splitlines():
+            if line.startswith('*'):
+                table = line[1:]
+            elif line.startswith(':'):
+                chain = line[1:].split(' ', 1)[0]
+                if chain in chains and chains[chain][0] == table:
+                    existing.add(chain)
+            elif line.startswith('-A '):
+                line_split = line.split()
+                if len(line_split) == 4 and line_split[2] == '-j' and \
+                        chains.get(line_split[3]) == (table, line_split[1]):
+                    jumps[line_split[3]] += 1
+        return existing, jumps
 
     def _set_iptables_rules(self):
         logger.debug('Setting iptables rules. %r' % {
             'server_id': self.id,
         })
-        for rule in self._generate_iptables_rules():
-            if not self._exists_iptables_rules(rule):
-                try:
-                    subprocess.check_call(['iptables', '-A'] + rule,
-                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                except subprocess.CalledProcessError:
-                    logger.exception('Failed to apply iptables ' + \
-                        'routing rule. %r' % {
-                            'server_id': self.id,
-                            'rule': rule,
-                        })
-                    raise
+        rules = self._generate_iptables_rules()
+        _, jumps = self._get_iptables_state()
+        lines = []
+
+        # Declaring a chain that already exists flushes it, jumps left
+        # by an earlier start are replaced so only one is kept
+        for table in ('filter', 'nat'):
+            lines.append('*%s' % table)
+            for chain_table, hook, chain in self._get_iptables_chains():
+                if chain_table == table:
+                    lines.append(':%s - [0:0]' % chain)
+            for chain_table, hook, chain in self._get_iptables_chains():
+                if chain_table == table:
+                    lines.extend(['-D %s -j %s' % (hook, chain)] *
+                        jumps[chain])
+            for rule_table, rule in rules:
+                if rule_table == table:
+                    lines.append(' '.join(['-A'] + rule))
+            for chain_table, hook, chain in self._get_iptables_chains():
+                if chain_table == table:
+                    lines.append('-A %s -j %s' % (hook, chain))
+            lines.append('COMMIT')
+
+        returncode, error = self._restore_iptables(lines)
+        if returncode:
+            raise IptablesError('Failed to apply iptables routing rules', {
+                'server_id': self.id,
+                'error': error,
+            })
 
     def _clear_iptables_rules(self):
         logger.debug('Clearing iptables rules. %r' % {
             'server_id': self.id,
         })
-        for rule in self._generate_iptables_rules():
-            if self._exists_iptables_rules(rule):
-                try:
-                    subprocess.check_call(['iptables', '-D'] + rule,
-                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                except subprocess.CalledProcessError:
-                    logger.exception('Failed to clear iptables ' + \
-                        'routing rule. %r' % {
-                            'server_id': self.id,
-                            'rule': rule,
-                        })
-                    raise
-
-    def _sub_thread(self, process):
-        for message in cache_db.subscribe(self.get_cache_key()):
-            try:
-                if message == 'stop':
-                    process.send_signal(signal.SIGINT)
-                elif message == 'force_stop':
-                    process.send_signal(signal.SIGKILL)
-                elif message == 'stopped':
-                    break
-            except OSError:
+        existing, jumps = self._get_iptables_state()
+        if not existing and not jumps:
+            return
+
+        lines = []
+        for table in ('filter', 'nat'):
+            lines.append('*%s' % table)
+            for chain_table, hook, chain in self._get_iptables_chains():
+                if chain_table == table:
+                    lines.extend(['-D %s -j %s' % (hook, chain)] *
+                        jumps[chain])
+                    if chain in existing:
+                        lines.append('-F %s' % chain)
+                        lines.append('-X %s' % chain)
+            lines.append('COMMIT')
+
+        if not self._restore_iptables(lines)[0]:
+            return
+
+        # Fails when the rules were changed since they were read, remove
+        # what is left one command at a time
+        logger.debug('Failed to clear iptables chains, ' + \
+                'removing individually. %r' % {
+            'server_id': self.id,
+        })
+        for table, hook, chain in self._get_iptables_chains():
+            while not subprocess.call(['iptables', '-t', table, '-D', hook,
+                    '-j', chain], stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE):
                 pass
+            for args in (['-F', chain], ['-X', chain]):
+                subprocess.call(['iptables', '-t', table] + args,
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
-    def _status_thread(self):
-        i = 0
-        cur_client_count = 0
-        while not self._interrupt:
-            # Check interrupt every 0.1s check client count every 1s
-            if i == 9:
-                i = 0
-                self.update_clients()
-            else:
-                i += 1
-            time.sleep(0.1)
-        self._clear_iptables_rules()
-
-    def _run_thread(self):
+    def _run(self):
         logger.debug('Starting ovpn process. %r' % {
             'server_id': self.id,
         })
-        self._interrupt = False
         try:
-            try:
-                process = subprocess.Popen(['openvpn', self.ovpn_conf_path],
-                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            except OSError:
-                self.push_output(traceback.format_exc())
-                logger.exception('Failed to start ovpn process. %r' % {
-                    'server_id': self.id,
-                })
-                self.publish('stopped')
-                return
-            sub_thread = threading.Thread(target=self._sub_thread,
-                args=(process,))
-            sub_thread.start()
-            status_thread = threading.Thread(target=self._status_thread)
-            status_thread.start()
-            self.status = True
-            self.publish('started')
-
-            while True:
-                line = process.stdout.readline()
-                if not line:
-                    if process.poll() is not None:
-                        break
-                    else:
-                        continue
-                self.push_output(line)
-
-            self._interrupt = True
-            status_thread.join()
+            supervisor.spawn(self, ['openvpn', self.ovpn_conf_path],
+                self._on_exit)
+        except OSError:
+            self.push_output(traceback.format_exc())
+            logger.exception('Failed to start ovpn process. %r' % {
+                'server_id': self.id,
+            })
+            self.publish('stopped')
+            return
+        self.status = True
+        status_watcher.add(self)
+        self.publish('started')
 
+    def _on_exit(self):
+        try:
+            status_watcher.remove(self)
             self.status = False
+            self._clear_iptables_rules()
+        finally:
             self.publish('stopped')
 
-            logger.debug('Ovpn process has ended. %r' % {
-                'server_id': self.id,
-            })
-        except:
-            self._interrupt = True
-            self.publish('stopped')
-            raise
+        logger.debug('Ovpn process has ended. %r' % {
+            'server_id': self.id,
+        })
 
     def publish(self, message):
         cache_db.publish(self.get_cache_key(), message)
 
-    def start(self):
+    def _send_event(self, action, events, check, callback=None):
+        # Subscribe before running the action so a fast reply is not
+        # missed, with a callback the reply is waited for on the ioloop
+        # and the callback is run with the error or None
+        if callback:
+            def on_message(message):
+                if message is not None and message not in events:
+                    return
+                subscription.cancel()
+                callback(check(message))
+            subscription = cache_db.subscribe_async(self.get_cache_key(),
+                on_message, SUB_RESPONSE_TIMEOUT)
+            action()
+            return
+
+        event = None
+        messages = cache_db.subscribe(self.get_cache_key(),
+            SUB_RESPONSE_TIMEOUT)
+        action()
+        for message in messages:
+            if message in events:
+                event = message
+                break
+        error = check(event)
+        if error:
+            raise error
+
+    def _check_start(self, event):
+        if event == 'stopped':
+            return ServerStartError('Server failed to start', {
+                'server_id': self.id,
+            })
+        elif event != 'started':
+            return ServerStartError(
+                'Server thread failed to return start event', {
+                    'server_id': self.id,
+                })
+
+    def _check_stop(self, event):
+        if event != 'stopped':
+            return ServerStopError(
+                'Server thread failed to return stop event', {
+                    'server_id': self.id,
+                })
+
+    def start(self, callback=None):
         if self.status:
+            if callback:
+                callback(None)
             return
         logger.debug('Starting server. %r' % {
             'server_id': self.id,
@@ -341,65 +450,97 @@ class Server:
         self._enable_ip_forwarding()
         self._set_iptables_rules()
 
-        threading.Thread(target=self._run_thread).start()
-
-        started = False
-        for message in cache_db.subscribe(self.get_cache_key(),
-                SUB_RESPONSE_TIMEOUT):
-            if message == 'started':
-                started = True
-                break
-            elif message == 'stopped':
-                raise ValueError('Server failed to start')
-        if not started:
-            raise ValueError('Server thread failed to return start event.')
+        self._send_event(functools.partial(
+            tornado.ioloop.IOLoop.instance().add_callback, self._run),
+            ('started', 'stopped'), self._check_start, callback)
 
-    def stop(self):
+    def stop(self, callback=None):
         if not self.status:
+            if callback:
+                callback(None)
             return
         logger.debug('Stopping server. %r' % {
             'server_id': self.id,
         })
+        if not callback:
+            self._stop(signal.SIGINT, SUB_RESPONSE_TIMEOUT)
+            return
+        self._send_event(functools.partial(self.publish, 'stop'),
+            ('stopped',), self._check_stop, callback)
 
-        stopped = False
-        self.publish('stop')
-        for message in cache_db.subscribe(self.get_cache_key(),
-                SUB_RESPONSE_TIMEOUT):
-            if message == 'stopped':
-                stopped = True
-                break
-        if not stopped:
-            raise ValueError('Server thread failed to return stop event.')
-
-    def force_stop(self):
+    def force_stop(self, callback=None):
         if not self.status:
+            if callback:
+                callback(None)
             return
         logger.debug('Forcing stop server. %r' % {
             'server_id': self.id,
         })
-
-        stopped = False
-        self.publish('force_stop')
-        for message in cache_db.subscribe(self.get_cache_key(),
-                SUB_RESPONSE_TIMEOUT):
-            if message == 'stopped':
-                stopped = True
-                break
-        if not stopped:
-            raise ValueError('Server thread failed to return stop event.')
+        if not callback:
+            self._stop(signal.SIGKILL)
+            return
+        self._send_event(functools.partial(self.publish, 'force_stop'),
+            ('stopped',), self._check_stop, callback)
+
+    def _stop(self, sig, timeout=None):
+        # Blocking stops do not wait for the stop event, the ioloop that
+        # delivers it may not be running when the app is shutting down
+        if not supervisor.stop(self, sig, timeout):
+            raise ServerStopError('Server process failed to stop', {
+                'server_id': self.id,
+            })
 
     def push_output(self, output):
-        self.call_buffer.create_call('push_output', [output.rstrip('\n')])
+        call_buffer = self.call_buffer
+        if call_buffer:
+            call_buffer.create_call('push_output', [output.rstrip('\n')],
+                low_priority=True)
 
-    def update_clients(self):
+    def push_lines(self, lines):
+        call_buffer = self.call_buffer
+        event_counts = self.event_counts
+        if not call_buffer or event_counts is None:
+            return
+        output_events = app_server.output_events
+        # Known log lines are also sent as typed events, only every
+        # raw_sample line is sent raw and all are sent without events
+        raw_sample = app_server.output_raw_sample or int(not output_events)
+        raw_lines = []
+        events = []
+        cur_time = int(time.time())
+
+        for line in lines:
+            event_counts[OUTPUT_LINES] += 1
+            if raw_sample and not event_counts[OUTPUT_LINES] % raw_sample:
+                raw_lines.append(line)
+            if not output_events:
+                continue
+            event = ovpn_events.parse_line(line)
+            if event:
+                event_counts[event['type']] += 1
+                event['time'] = cur_time
+                events.append(event)
+
+        if raw_lines:
+            call_buffer.create_call('push_output', ['\n'.join(raw_lines)],
+                low_priority=True)
+        if events:
+            call_buffer.create_call('push_events', [events], event=True)
+
+    def update_clients(self, clients=None):
         if not self.status:
             return {}
-        clients = {}
 
-        if os.path.isfile(self.ovpn_status_path):
+        if clients is not None:
+            clients = dict(clients)
+        elif os.path.isfile(self.ovpn_status_path):
+            clients = {}
             with open(self.ovpn_status_path, 'r') as status_file:
-                for line in status_file.readlines():
+                for line in status_file:
                     if line[:11] != 'CLIENT_LIST':
+                        # Client lines come first, stop at the routing table
+                        if line.startswith('HEADER,ROUTING_TABLE'):
+                            break
                         continue
                     line_split = line.strip('\n').split(',')
                     client_id = line_split[1]
@@ -415,6 +556,8 @@ class Server:
                         'bytes_sent': int(bytes_sent),
                         'connected_since': int(connected_since),
                     }
+        else:
+            clients = {}
 
         client_count = len(clients)
         if client_count != self._cur_client_count:
@@ -426,8 +569,7 @@ class Server:
 
     @staticmethod
     def get_server(id):
-        if os.path.isdir(os.path.join(app_server.data_path, id)):
-            return Server(id=id)
+        return _servers.get(id)
 
     @staticmethod
     def get_servers():
@@ -435,8 +577,16 @@ class Server:
         path = os.path.join(app_server.data_path)
         servers = []
         if os.path.isdir(path):
+            # Includes server directories left by a previous process
             for server_id in os.listdir(path):
-                server = Server.get_server(id=server_id)
+                server = _servers.get(server_id)
                 if server:
                     servers.append(server)
+                elif os.path.isdir(os.path.join(path, server_id)):
+                    servers.append(Server(id=server_id))
         return servers
+
+    @staticmethod
+    def get_running_servers():
+        logger.debug('Getting running servers.')
+        return [x for x in _servers.itervalues() if x.status]
@@ -0,0 +1,91 @@
+from constants import *
+from management import ManagementClient
+import tornado.ioloop
+import functools
+import logging
+import os
+
+logger = logging.getLogger(APP_NAME)
+
+class StatusWatcher:
+    def __init__(self):
+        self._servers = {}
+        self._stats = {}
+        self._managements = {}
+        self._periodic = None
+
+    def add(self, server):
+        # Servers are added on the ioloop but a blocking stop removes them
+        # from the calling thread, all watcher state is only changed on
+        # the ioloop
+        tornado.ioloop.IOLoop.instance().add_callback(
+            functools.partial(self._add, server))
+
+    def remove(self, server):
+        tornado.ioloop.IOLoop.instance().add_callback(
+            functools.partial(self._remove, server))
+
+    def _add(self, server):
+        self._servers[server.id] = server
+        self._stats.pop(server.id, None)
+        management = self._managements.pop(server.id, None)
+        if management:
+            management.close()
+        self._managements[server.id] = ManagementClient(
+            server.ovpn_management_path,
+            functools.partial(self._on_clients, server))
+        if not self._periodic:
+            self._periodic = tornado.ioloop.PeriodicCallback(self._check,
+                STATUS_CHECK_INTERVAL * 1000)
+            self._periodic.start()
+
+    def _remove(self, server):
+        if self._servers.get(server.id) is not server:
+            return
+        del self._servers[server.id]
+        self._stats.pop(server.id, None)
+        self._managements.pop(server.id).close()
+        if not self._servers and self._periodic:
+            self._periodic.stop()
+            self._periodic = None
+
+    def _on_clients(self, server, clients):
+        if self._servers.get(server.id) is not server:
+            return
+        try:
+            server.update_clients(clients)
+        except:
+            logger.exception('Failed to update server clients. %r' % {
+                'server_id': server.id,
+            })
+
+    def _check(self):
+        for server_id, server in self._servers.items():
+            # Query the management interface when connected, the status
+            # file is only read until openvpn has opened the socket
+            management = self._managements[server_id]
+            if management.connected:
+                management.query_status()
+                continue
+            elif not management.connecting and \
+                    os.path.exists(server.ovpn_management_path):
+                management.connect()
+
+            # Only parse status files that were rewritten since last check
+            try:
+                status_stat = os.stat(server.ovpn_status_path)
+            except OSError:
+                continue
+            stat = (status_stat.st_mtime, status_stat.st_size)
+            if self._stats.get(server_id) == stat:
+                continue
+            self._stats[server_id] = stat
+
+            try:
+                server.update_clients()
+            except:
+                logger.exception('Failed to update server clients. %r' % {
+                    'server_id': server_id,
+                })
+
+status_watcher = StatusWatcher()
@@ -0,0 +1,104 @@
+from constants import *
+from cache import cache_db
+from output_reader import output_reader
+import tornado.ioloop
+import threading
+import subprocess
+import functools
+import logging
+import signal
+import time
+
+logger = logging.getLogger(APP_NAME)
+
+class SupervisedProcess:
+    def __init__(self, server, process, callback):
+        self.server = server
+        self.process = process
+        self.callback = callback
+        self.subscription = None
+
+class Supervisor:
+    # Runs the server processes from the ioloop, output is read by the
+    # output reader and control messages are received with an async
+    # subscription so no threads are used for each server
+    def __init__(self):
+        self._processes = {}
+        self._lock = threading.Lock()
+
+    def spawn(self, server, args, callback):
+        # Must be called on the ioloop, the callback is run once the
+        # process has exited and its output is closed
+        process = subprocess.Popen(args, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+        supervised = SupervisedProcess(server, process, callback)
+        with self._lock:
+            self._processes[server.id] = supervised
+        supervised.subscription = cache_db.subscribe_async(
+            server.get_cache_key(),
+            functools.partial(self._on_message, supervised))
+        output_reader.add(server, process.stdout,
+            functools.partial(self._reap, supervised))
+        return process
+
+    def _on_message(self, supervised, message):
+        try:
+            if message == 'stop':
+                supervised.process.send_signal(signal.SIGINT)
+            elif message == 'force_stop':
+                supervised.process.send_signal(signal.SIGKILL)
+        except OSError:
+            pass
+
+    def _reap(self, supervised):
+        # Output is closed when the process exits, the exit status may
+        # not be available yet
+        if supervised.process.poll() is None:
+            tornado.ioloop.IOLoop.instance().add_timeout(
+                time.time() + SUPERVISOR_REAP_INTERVAL,
+                functools.partial(self._reap, supervised))
+            return
+
+        self._finish(supervised)
+
+    def _finish(self, supervised):
+        # Run once by whichever of the reaper or stop sees the exit first
+        with self._lock:
+            if self._processes.get(supervised.server.id) is not supervised:
+                return
+            del self._processes[supervised.server.id]
+
+        supervised.subscription.cancel()
+        try:
+            supervised.callback()
+        except:
+            logger.exception('Failed to run process exit callback. %r' % {
+                'server_id': supervised.server.id,
+                'returncode': supervised.process.returncode,
+            })
+
+    def stop(self, server, sig, timeout=None):
+        # Signals and waits for the process without the ioloop so servers
+        # can be stopped after it has stopped, the exit callback is run
+        # inline, returns False if the process did not exit in time
+        with self._lock:
+            supervised = self._processes.get(server.id)
+        if not supervised:
+            return True
+
+        try:
+            supervised.process.send_signal(sig)
+        except OSError:
+            pass
+
+        if timeout is not None:
+            end_time = time.time() + timeout
+        while supervised.process.poll() is None:
+            if timeout is not None and time.time() >= end_time:
+                return False
+            time.sleep(SUPERVISOR_REAP_INTERVAL)
+
+        self._finish(supervised)
+        return True
+
+supervisor = Supervisor()
@@ -63,7 +63,7 @@ setup(
     license=open('LICENSE').read(),
     zip_safe=False,
     install_requires=[
-        'tornado>=2.1.0',
+        'tornado>=3.0.0',
     ],
     data_files=data_files,
     entry_points={
@@ -0,0 +1,37 @@
+import os
+import sys
+import gc
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..'))
+from pritunl_node.cache import Cache
+
+# Sets short string keys and reports the memory used by each key, the
+# keys and values are created before the first measurement so only the
+# cache entries are counted
+KEYS = 1000000
+
+def get_rss():
+    with open('/proc/self/statm', 'r') as statm_file:
+        pages = int(statm_file.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+if __name__ == '__main__':
+    keys = int(sys.argv[1]) if len(sys.argv) > 1 else KEYS
+    items = [('key-%s' % i, 'value-%s' % i) for i in xrange(keys)]
+    cache = Cache()
+    gc.collect()
+    start_rss = get_rss()
+    start = time.time()
+
+    for key, value in items:
+        cache.set(key, value)
+
+    duration = time.time() - start
+    gc.collect()
+    rss = get_rss() - start_rss
+    print 'keys: %s' % keys
+    print 'set: %.2fs rss: %sk per key: %.1f bytes' % (duration,
+        rss / 1024, float(rss) / keys)
+    print 'used memory: %s' % cache.get_memory_stats()['used_memory']
@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..'))
+from pritunl_node.cache import Cache
+
+# Mixed workload of the server handlers, each thread works on its own
+# server keys and the shared auth log
+THREADS = 8
+OPS = 20000
+SERVERS = 64
+SHARD_COUNTS = (1, 2, 4, 8, 16, 32)
+
+def worker(cache, thread_id, ops):
+    for i in xrange(ops):
+        key = 'server-%s-%s' % (thread_id, i % SERVERS)
+        op = i % 5
+        if op == 0:
+            cache.increment(key + '-events')
+        elif op == 1:
+            cache.dict_set(key + '-clients', str(i % 16), str(i))
+        elif op == 2:
+            cache.list_rpush(key + '-output', 'line %s' % i)
+        elif op == 3:
+            cache.list_lpop(key + '-output')
+        else:
+            cache.get(key + '-events')
+            cache.dict_get(key + '-clients', str(i % 16))
+
+def run(shards, threads, ops):
+    cache = Cache(shards=shards)
+    workers = [threading.Thread(target=worker, args=(cache, x, ops))
+        for x in xrange(threads)]
+    start = time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    duration = time.time() - start
+
+    # Every increment must be counted with no lost updates
+    count = 0
+    for thread_id in xrange(threads):
+        for server in xrange(SERVERS):
+            count += int(cache.get('server-%s-%s-events' % (
+                thread_id, server)) or 0)
+    expected = threads * len(xrange(0, ops, 5))
+    if count != expected:
+        raise ValueError('Lost updates, counted %s of %s' % (
+            count, expected))
+
+    return threads * ops / duration
+
+if __name__ == '__main__':
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else THREADS
+    ops = int(sys.argv[2]) if len(sys.argv) > 2 else OPS
+
+    print 'threads: %s ops per thread: %s' % (threads, ops)
+    for shards in SHARD_COUNTS:
+        print 'shards: %-3s ops/sec: %.0f' % (shards,
+            run(shards, threads, ops))
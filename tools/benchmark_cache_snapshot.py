@@ -0,0 +1,84 @@
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..'))
+from pritunl_node.cache import Cache
+
+# Writes a snapshot of dict keys like the server and user records and
+# imports it in a new process so the cold start time and peak memory are
+# not affected by the writer
+KEYS = 200000
+FIELDS = 8
+
+def generate(cache, keys):
+    for i in xrange(keys):
+        cache.dict_set_many('user-%s' % i, {
+            'field_%s' % x: 'value-%s-%s' % (i, x) for x in xrange(FIELDS)})
+
+def write_json(path, cache):
+    # Ver 1 json databases are still imported for compatibility
+    data = []
+    for key in cache.scan_iter(count=1000):
+        data.append([key, 'dict', None, cache.dict_get_all(key)])
+    with open(path, 'w') as db_file:
+        db_file.write(json.dumps({
+            'data': data,
+            'commit_log': [],
+        }))
+
+def run_import(path):
+    start = time.time()
+    cache = Cache()
+    cache._path = path
+    cache.import_data()
+    duration = time.time() - start
+    print json.dumps({
+        'duration': duration,
+        'keys': sum(len(shard.data) for shard in cache._shards),
+        'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    })
+
+def measure(path):
+    output = subprocess.check_output([sys.executable,
+        os.path.abspath(__file__), '--import', path])
+    return json.loads(output)
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--import']:
+        run_import(sys.argv[2])
+        sys.exit(0)
+
+    keys = int(sys.argv[1]) if len(sys.argv) > 1 else KEYS
+    temp_dir = tempfile.mkdtemp()
+    try:
+        cache = Cache()
+        generate(cache, keys)
+
+        snapshot_path = os.path.join(temp_dir, 'snapshot')
+        cache._path = snapshot_path
+        start = time.time()
+        cache.export_data()
+        export_duration = time.time() - start
+
+        json_path = os.path.join(temp_dir, 'json')
+        write_json(json_path, cache)
+
+        print 'keys: %s fields: %s' % (keys, FIELDS)
+        print 'export: %.2fs size: %sk' % (export_duration,
+            os.path.getsize(snapshot_path) / 1024)
+        for name, path in (('snapshot', snapshot_path), ('json', json_path)):
+            result = measure(path)
+            if result['keys'] != keys:
+                raise ValueError('Imported %s of %s keys' % (
+                    result['keys'], keys))
+            print '%s import: %.2fs max rss: %sk' % (name,
+                result['duration'], result['max_rss'])
+    finally:
+        shutil.rmtree(temp_dir)
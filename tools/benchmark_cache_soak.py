@@ -0,0 +1,46 @@
+import os
+import sys
+import gc
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..'))
+from pritunl_node.cache import Cache
+
+# Creates and destroys servers the way the handlers do, the channels and
+# locks of removed servers must be reclaimed so memory stays flat
+SERVERS = 100000
+REPORT_INTERVAL = 10000
+
+def get_rss():
+    with open('/proc/self/statm', 'r') as statm_file:
+        pages = int(statm_file.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1024
+
+def cycle(cache, server_id):
+    key = 'server-%s' % server_id
+    subscriber = cache.subscribe(key, timeout=0)
+    cache.publish(key, 'started')
+    cache.lock_acquire(key + '-lock')
+    cache.dict_set(key + '-clients', 'client', 'connected')
+    cache.lock_release(key + '-lock')
+    cache.publish(key, 'stopped')
+    subscriber.cancel()
+    cache.remove(key + '-clients')
+
+if __name__ == '__main__':
+    servers = int(sys.argv[1]) if len(sys.argv) > 1 else SERVERS
+    cache = Cache()
+    start = time.time()
+
+    for server_id in xrange(1, servers + 1):
+        cycle(cache, server_id)
+        if server_id % REPORT_INTERVAL == 0:
+            gc.collect()
+            stats = cache.get_gc_stats()
+            print ('servers: %-7s rss: %-7s channels: %s/%s ' +
+                'locks: %s/%s') % (server_id, '%sk' % get_rss(),
+                stats['channels'], stats['channels_reclaimed'],
+                stats['locks'], stats['locks_reclaimed'])
+
+    print 'servers/sec: %.0f' % (servers / (time.time() - start))
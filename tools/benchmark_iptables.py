@@ -0,0 +1,92 @@
+import os
+import sys
+import time
+import uuid
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..'))
+import pritunl_node
+from pritunl_node.server import Server
+from pritunl_node.route_table import route_table
+
+# Stub binaries count each fork so the rules can be set and cleared
+# without root, iptables-save reports the server chains as already set
+RUNS = 50
+RESTORE_STUB = '#!/bin/sh\ncat > /dev/null\necho %s >> "%s"\n'
+SAVE_STUB = '#!/bin/sh\necho %s >> "%s"\ncat "%s"\n'
+ROUTES = """Iface\tDestination\tGateway\tFlags\tRefCnt\tUse\tMetric\tMask
+eth0\t00000000\t0101A8C0\t0003\t0\t0\t100\t00000000
+eth0\t0001A8C0\t00000000\t0001\t0\t0\t100\t00FFFFFF
+eth1\t0000000A\t00000000\t0001\t0\t0\t0\t000000FF
+eth2\t000010AC\t00000000\t0001\t0\t0\t0\t0000F0FF"""
+LOCAL_NETWORKS = ['192.168.1.0/24', '10.0.0.0/8', '172.16.0.0/12',
+    '192.168.50.0/24']
+
+def write_stub(path, data):
+    with open(path, 'w') as stub_file:
+        stub_file.write(data)
+    os.chmod(path, 0755)
+
+def write_state(path, server):
+    lines = []
+    for table in ('filter', 'nat'):
+        lines.append('*%s' % table)
+        for chain_table, hook, chain in server._get_iptables_chains():
+            if chain_table == table:
+                lines.append(':%s - [0:0]' % chain)
+                lines.append('-A %s -j %s' % (hook, chain))
+        lines.append('COMMIT')
+    with open(path, 'w') as state_file:
+        state_file.write('\n'.join(lines) + '\n')
+
+def count_forks(forks_path):
+    if not os.path.exists(forks_path):
+        return 0
+    with open(forks_path, 'r') as forks_file:
+        count = len(forks_file.readlines())
+    os.remove(forks_path)
+    return count
+
+def measure(method, forks_path, runs):
+    start = time.time()
+    for _ in xrange(runs):
+        method()
+    duration = (time.time() - start) / runs
+    return count_forks(forks_path) / runs, duration * 1000
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else RUNS
+    temp_dir = tempfile.mkdtemp()
+    try:
+        bin_path = os.path.join(temp_dir, 'bin')
+        forks_path = os.path.join(temp_dir, 'forks')
+        state_path = os.path.join(temp_dir, 'state')
+        os.makedirs(bin_path)
+        write_stub(os.path.join(bin_path, 'iptables-restore'),
+            RESTORE_STUB % ('iptables-restore', forks_path))
+        write_stub(os.path.join(bin_path, 'iptables-save'),
+            SAVE_STUB % ('iptables-save', forks_path, state_path))
+        os.environ['PATH'] = bin_path + os.pathsep + os.environ['PATH']
+
+        route_table.path = os.path.join(temp_dir, 'route')
+        with open(route_table.path, 'w') as route_file:
+            route_file.write(ROUTES + '\n')
+
+        pritunl_node.app_server.data_path = temp_dir
+        server = Server(
+            id=uuid.uuid4().hex,
+            interface='tun0',
+            network='10.200.0.0/24',
+            local_networks=LOCAL_NETWORKS,
+        )
+        write_state(state_path, server)
+
+        print 'runs: %s local networks: %s' % (runs, len(LOCAL_NETWORKS))
+        print 'start forks: %s latency: %.2fms' % measure(
+            server._set_iptables_rules, forks_path, runs)
+        print 'stop forks: %s latency: %.2fms' % measure(
+            server._clear_iptables_rules, forks_path, runs)
+    finally:
+        shutil.rmtree(temp_dir)